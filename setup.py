@@ -27,6 +27,9 @@ setup(
         'easy-thumbnails>=2.7',
         'python-pam',
     ],
+    extras_require={
+        'watch': ['inotify_simple'],
+    },
     classifiers=[
         'Development Status :: 4 - Beta',
         'Environment :: Web Environment',
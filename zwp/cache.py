@@ -1,10 +1,149 @@
 from django.core.cache import cache
 from django.core.cache.utils import make_template_fragment_key
+import os
+import time
+from .settings import ZWP_METADATA_DIR
 
 
-def clear_dir_content_cache(request, d):
-    k = make_template_fragment_key(
-        'zwp_dir_content',
-        [d.ds.name, d.full_path, request.user.username],
+# ZIP progress is kept long enough for clients to see the finished state
+ZIP_PROGRESS_TIMEOUT = 24 * 60 * 60
+
+# How often is the progress checked by waiting requests, in seconds. The delay
+# between checks doubles up to the maximum while the progress is unchanged.
+ZIP_PROGRESS_POLL_INTERVAL = 0.25
+ZIP_PROGRESS_POLL_MAX_INTERVAL = 1
+
+
+def dir_version(ds_name, path):
+    """
+    Return the current cache version of directory ``path``. The version is
+    a part of all cache keys related to the directory, it is changed by
+    :func:`invalidate_dir`.
+    """
+    key = _version_key(ds_name, path)
+    v = cache.get(key)
+
+    if v is None:
+        # Initialize with a time-based value, so that keys from before the
+        # version was evicted from the cache are not reused
+        cache.add(key, int(time.time() * 1000), None)
+        v = cache.get(key)
+
+    return v
+
+
+def invalidate_dir(ds_name, path):
+    """
+    Invalidate cached instances and rendered content of directory ``path``
+    for all users.
+    """
+    key = _version_key(ds_name, path)
+
+    try:
+        cache.incr(key)
+
+    except ValueError:
+        cache.set(key, int(time.time() * 1000), None)
+
+
+def invalidate_path(ds_name, path):
+    """
+    Invalidate caches affected by a change inside directory ``path``, which
+    is relative to the data source root and may point into a metadata
+    directory. The parent data directory is invalidated as well, as it holds
+    the label and accessibility of its children.
+    """
+    path = dir_of_path(path)
+    invalidate_dir(ds_name, path)
+
+    if path:
+        invalidate_dir(ds_name, os.path.dirname(path))
+
+
+def dir_of_path(path):
+    """
+    Return the data directory that ``path`` belongs to, i.e. strip
+    the metadata directory and its subdirectories, if present.
+    """
+    components = [] if path in ('', '.') else path.split(os.sep)
+
+    if ZWP_METADATA_DIR in components:
+        components = components[0:components.index(ZWP_METADATA_DIR)]
+
+    return os.path.join(*components) if components else ''
+
+
+def dir_instance_key(ds_name, path):
+    return make_template_fragment_key(
+        'zwp_dir_instance',
+        [ds_name, path, dir_version(ds_name, path)]
     )
-    cache.delete(k)
+
+
+def dir_state_key(instance_key):
+    """
+    Return the key of the state of a cached directory, see
+    :meth:`zwp.models.Directory.cached_state`, for the key of the directory
+    from :func:`dir_instance_key`.
+    """
+    return instance_key + '.state'
+
+
+def tree_node_key(ds_name, path, lang, stamp):
+    return make_template_fragment_key(
+        'zwp_tree_node',
+        [ds_name, path, lang, stamp]
+    )
+
+
+def get_zip_progress(batch_pk):
+    """
+    Return the progress of ZIP file creation published by
+    :func:`set_zip_progress`, or ``None``.
+    """
+    return cache.get(_zip_progress_key(batch_pk))
+
+
+def wait_zip_progress(batch_pk, seq, state, timeout, interval):
+    """
+    Wait until the progress of ZIP file creation changes from sequence number
+    ``seq`` and return it. Changes of ``state`` are returned as soon as they are
+    noticed, other progress at most every ``interval`` seconds. Returns the current progress,
+    which may be ``None``, after ``timeout`` seconds.
+    """
+    start = time.monotonic()
+    delay = ZIP_PROGRESS_POLL_INTERVAL
+
+    while True:
+        progress = get_zip_progress(batch_pk)
+        elapsed = time.monotonic() - start
+
+        if progress is None or progress['state'] != state or elapsed >= timeout:
+            return progress
+
+        if progress['seq'] != seq and elapsed >= interval:
+            return progress
+
+        time.sleep(min(delay, timeout - elapsed))
+        delay = min(delay * 2, ZIP_PROGRESS_POLL_MAX_INTERVAL)
+
+
+def set_zip_progress(batch_pk, progress):
+    cache.set(_zip_progress_key(batch_pk), progress, ZIP_PROGRESS_TIMEOUT)
+
+
+def clear_zip_progress(batch_pk):
+    """
+    Remove progress of an earlier attempt to create the ZIP file, so that
+    waiting clients do not see its final state. Called whenever the batch
+    is queued or its ZIP file is being created again.
+    """
+    cache.delete(_zip_progress_key(batch_pk))
+
+
+def _zip_progress_key(batch_pk):
+    return make_template_fragment_key('zwp_zip_progress', [batch_pk])
+
+
+def _version_key(ds_name, path):
+    return make_template_fragment_key('zwp_dir_version', [ds_name, path])
@@ -0,0 +1,406 @@
+import configparser
+import json
+import os
+import sqlite3
+import threading
+from .settings import ZWP_CATALOG, ZWP_METADATA_DIR, ZWP_METADATA_FILE, ZWP_ACL_FILE
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS info (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS dirs (
+    ds_name TEXT NOT NULL,
+    path TEXT NOT NULL,
+    mtime INTEGER NOT NULL,
+    PRIMARY KEY (ds_name, path)
+);
+CREATE TABLE IF NOT EXISTS entries (
+    ds_name TEXT NOT NULL,
+    dir_path TEXT NOT NULL,
+    name TEXT NOT NULL,
+    is_dir INTEGER NOT NULL,
+    size INTEGER,
+    mtime REAL,
+    PRIMARY KEY (ds_name, dir_path, name)
+);
+CREATE TABLE IF NOT EXISTS files (
+    ds_name TEXT NOT NULL,
+    dir_path TEXT NOT NULL,
+    name TEXT NOT NULL,
+    mtime INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    data TEXT NOT NULL,
+    directory TEXT NOT NULL,
+    PRIMARY KEY (ds_name, dir_path, name)
+);
+"""
+
+TABLES = ('dirs', 'entries', 'files')
+
+# Files from the metadata directory whose parsed contents are stored
+# in the catalog
+CONFIG_FILES = (ZWP_ACL_FILE, ZWP_METADATA_FILE)
+
+
+class Catalog:
+    """
+    On-disk catalog of data source contents, stored in an SQLite database.
+
+    The catalog contains directory listings, part sizes and mtimes and parsed
+    contents of ACL and metadata files. It is built and kept up to date by
+    the ``scancatalog`` management command, directories and parts then serve
+    their listings from the catalog instead of the file system.
+    """
+    VERSION = 2
+
+    def __init__(self, path):
+        self._path = path
+        self._local = threading.local()
+
+    @property
+    def conn(self):
+        conn = getattr(self._local, 'conn', None)
+
+        if conn is None:
+            conn = sqlite3.connect(self._path)
+            conn.executescript(SCHEMA)
+            self._check_version(conn)
+            self._local.conn = conn
+
+        return conn
+
+    def has_dir(self, ds_name, path):
+        return self.conn.execute(
+            'SELECT 1 FROM dirs WHERE ds_name = ? AND path = ?',
+            (ds_name, path)
+        ).fetchone() is not None
+
+    def entries(self, ds_name, path):
+        """
+        Return a list of ``(name, is_dir, size, mtime)`` tuples sorted by name,
+        or ``None`` if the directory is not in the catalog.
+        """
+        if not self.has_dir(ds_name, path):
+            return None
+
+        return [
+            (name, bool(is_dir), size, mtime)
+            for name, is_dir, size, mtime in self.conn.execute(
+                'SELECT name, is_dir, size, mtime FROM entries '
+                'WHERE ds_name = ? AND dir_path = ? ORDER BY name',
+                (ds_name, path)
+            )
+        ]
+
+    def config(self, ds_name, path, name, directory=False):
+        """
+        Return parsed contents of config file ``name`` from the metadata
+        directory of ``path`` as a dictionary of sections. If ``directory``
+        is set, only the ``Directory`` section is returned, if present.
+        Returns ``False`` if the file does not exist and ``None`` if
+        the directory is not in the catalog.
+        """
+        row = self.conn.execute(
+            'SELECT f.{} FROM dirs d LEFT JOIN files f '
+            'ON f.ds_name = d.ds_name AND f.dir_path = d.path AND f.name = ? '
+            'WHERE d.ds_name = ? AND d.path = ?'.format('directory' if directory else 'data'),
+            (name, ds_name, path)
+        ).fetchone()
+
+        if row is None:
+            return None
+
+        if row[0] is None:
+            return False
+
+        return json.loads(row[0])
+
+    def scan(self, ds, full=False):
+        """
+        Update the catalog with contents of data source ``ds``. Only
+        directories whose mtime has changed since the last scan are listed
+        again, unless ``full`` is set. Files of other directories are stat'ed
+        to refresh sizes and mtimes of parts modified in place, which does not
+        change the directory mtime.
+
+        Directories reachable by more than one path, e.g. through symbolic
+        links, are scanned only once. Directories with names that are not
+        valid UTF-8 are not catalogued, see :func:`is_storable`.
+
+        Returns a dictionary with counts of scanned, updated and removed
+        directories and of refreshed files.
+        """
+        conn = self.conn
+        known = dict(conn.execute(
+            'SELECT path, mtime FROM dirs WHERE ds_name = ?',
+            (ds.name,)
+        ))
+        seen = set()
+        visited = set()  # real paths of scanned directories
+        stats = {'scanned': 0, 'updated': 0, 'removed': 0, 'refreshed': 0}
+        stack = ['']
+
+        with conn:
+            while stack:
+                path = stack.pop()
+                abs_path = os.path.join(ds.path, path)
+
+                try:
+                    mtime = os.stat(abs_path).st_mtime_ns
+
+                except OSError:
+                    continue
+
+                real_path = os.path.realpath(abs_path)
+
+                if real_path in visited:
+                    continue
+
+                visited.add(real_path)
+                seen.add(path)
+                stats['scanned'] += 1
+
+                if full or known.get(path) != mtime:
+                    subdirs = self._update_dir(ds, path, abs_path, mtime)
+                    stats['updated'] += 1
+
+                else:
+                    subdirs, refreshed = self._refresh_dir(ds, path, abs_path)
+                    stats['refreshed'] += refreshed
+
+                self._update_config_files(ds, path, abs_path, full)
+                stack.extend(os.path.join(path, d) for d in subdirs)
+
+            for path in set(known) - seen:
+                self._remove_dir(ds.name, path)
+                stats['removed'] += 1
+
+        return stats
+
+    def update(self, ds, path):
+        """
+        Update a single directory ``path`` of data source ``ds`` without
+        descending into its subdirectories. If the directory no longer exists,
+        it is removed from the catalog along with its subdirectories.
+        """
+        if not is_storable(path):
+            return
+
+        abs_path = os.path.join(ds.path, path)
+
+        with self.conn:
+            try:
+                mtime = os.stat(abs_path).st_mtime_ns
+
+            except OSError:
+                self._remove_tree(ds.name, path)
+                return
+
+            self._update_dir(ds, path, abs_path, mtime)
+            self._update_config_files(ds, path, abs_path, True)
+
+    def _update_dir(self, ds, path, abs_path, mtime):
+        subdirs = []
+        rows = []
+
+        with os.scandir(abs_path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir():
+                        if entry.name == ZWP_METADATA_DIR or not is_storable(entry.name):
+                            continue
+
+                        subdirs.append(entry.name)
+                        rows.append((ds.name, path, entry.name, 1, None, None))
+
+                    elif entry.is_file():
+                        st = entry.stat()
+                        rows.append((
+                            ds.name,
+                            path,
+                            entry.name.encode('utf8', 'replace').decode('utf-8'),
+                            0,
+                            st.st_size,
+                            st.st_mtime
+                        ))
+
+                except OSError:
+                    continue
+
+        self.conn.execute(
+            'DELETE FROM entries WHERE ds_name = ? AND dir_path = ?',
+            (ds.name, path)
+        )
+        self.conn.executemany(
+            'INSERT INTO entries (ds_name, dir_path, name, is_dir, size, mtime) '
+            'VALUES (?, ?, ?, ?, ?, ?)',
+            rows
+        )
+        self.conn.execute(
+            'INSERT OR REPLACE INTO dirs (ds_name, path, mtime) VALUES (?, ?, ?)',
+            (ds.name, path, mtime)
+        )
+
+        return subdirs
+
+    def _refresh_dir(self, ds, path, abs_path):
+        """
+        Update sizes and mtimes of files in directory ``path`` without
+        listing it again. Returns a list of its subdirectories and the number
+        of updated files.
+        """
+        subdirs = []
+        rows = []
+
+        for name, is_dir, size, mtime in self.conn.execute(
+            'SELECT name, is_dir, size, mtime FROM entries WHERE ds_name = ? AND dir_path = ?',
+            (ds.name, path)
+        ).fetchall():
+            if is_dir:
+                subdirs.append(name)
+                continue
+
+            try:
+                st = os.stat(os.path.join(abs_path, name))
+
+            except OSError:
+                continue
+
+            if (st.st_size, st.st_mtime) != (size, mtime):
+                rows.append((st.st_size, st.st_mtime, ds.name, path, name))
+
+        self.conn.executemany(
+            'UPDATE entries SET size = ?, mtime = ? '
+            'WHERE ds_name = ? AND dir_path = ? AND name = ?',
+            rows
+        )
+
+        return subdirs, len(rows)
+
+    def _update_config_files(self, ds, path, abs_path, full):
+        for name in CONFIG_FILES:
+            file_path = os.path.join(abs_path, ZWP_METADATA_DIR, name)
+            row = self.conn.execute(
+                'SELECT mtime, size FROM files WHERE ds_name = ? AND dir_path = ? AND name = ?',
+                (ds.name, path, name)
+            ).fetchone()
+
+            try:
+                st = os.stat(file_path)
+
+            except OSError:
+                if row is not None:
+                    self.conn.execute(
+                        'DELETE FROM files WHERE ds_name = ? AND dir_path = ? AND name = ?',
+                        (ds.name, path, name)
+                    )
+
+                continue
+
+            if not full and row == (st.st_mtime_ns, st.st_size):
+                continue
+
+            sections = read_sections(file_path)
+            directory = {k: v for k, v in sections.items() if k == 'Directory'}
+
+            self.conn.execute(
+                'INSERT OR REPLACE INTO files (ds_name, dir_path, name, mtime, size, data, directory) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (ds.name, path, name, st.st_mtime_ns, st.st_size,
+                 json.dumps(sections), json.dumps(directory))
+            )
+
+    def _remove_dir(self, ds_name, path):
+        for table, column in zip(TABLES, ('path', 'dir_path', 'dir_path')):
+            self.conn.execute(
+                'DELETE FROM {} WHERE ds_name = ? AND {} = ?'.format(table, column),
+                (ds_name, path)
+            )
+
+    def _remove_tree(self, ds_name, path):
+        rows = self.conn.execute(
+            "SELECT path FROM dirs WHERE ds_name = ? AND (path = ? OR path LIKE ? ESCAPE '\\')",
+            (ds_name, path, _escape_like(path) + '/%')
+        ).fetchall()
+
+        for (subdir,) in rows:
+            self._remove_dir(ds_name, subdir)
+
+    def _check_version(self, conn):
+        row = conn.execute("SELECT value FROM info WHERE key = 'version'").fetchone()
+
+        if row is not None and int(row[0]) == self.VERSION:
+            return
+
+        # Tables of other versions may have different columns, they are
+        # created again
+        for table in TABLES:
+            conn.execute('DROP TABLE IF EXISTS {}'.format(table))
+
+        conn.executescript(SCHEMA)
+
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO info (key, value) VALUES ('version', ?)",
+                (str(self.VERSION),)
+            )
+
+
+def read_sections(path):
+    """
+    Read INI file at ``path`` into a dictionary of sections with raw,
+    uninterpolated values, suitable for ``ConfigParser.read_dict()``.
+    """
+    cfg = configparser.ConfigParser(interpolation=None)
+    cfg.read(path)
+
+    ret = {}
+
+    if cfg.defaults():
+        ret[cfg.default_section] = dict(cfg.defaults())
+
+    for section in cfg.sections():
+        ret[section] = {k: v for k, v in cfg.items(section, raw=True)}
+
+    return ret
+
+
+def is_storable(name):
+    """
+    Return ``True`` if directory ``name`` can be stored in the catalog. Names
+    that are not valid UTF-8 are decoded with surrogate escapes, which SQLite
+    does not accept.
+    """
+    try:
+        name.encode('utf-8')
+
+    except UnicodeEncodeError:
+        return False
+
+    return True
+
+
+def _escape_like(s):
+    return s.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+_catalog = None
+
+
+def get_catalog():
+    """
+    Return the catalog configured by ``ZWP_CATALOG``, or ``None``
+    if the catalog is disabled.
+    """
+    global _catalog
+
+    if not ZWP_CATALOG:
+        return None
+
+    if _catalog is None:
+        _catalog = Catalog(ZWP_CATALOG)
+
+    return _catalog
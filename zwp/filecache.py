@@ -0,0 +1,72 @@
+from collections import OrderedDict
+import os
+import threading
+
+
+class FileCache:
+    """
+    Process-wide LRU cache of values read from files or directories. Entries
+    are validated by mtime and size of the file, so that files shared by many
+    directories and users are read only once per process.
+
+    Cached values are shared and must not be modified.
+    """
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key: (stamp, value)
+        self._lock = threading.Lock()
+
+    def lookup(self, path, key, load):
+        """
+        Return the value cached under ``key`` if file ``path`` has not changed
+        since, otherwise call ``load`` and cache its result. Returns ``None``
+        if the file does not exist or ``load`` raises :class:`OSError`.
+        """
+        try:
+            st = os.stat(path)
+
+        except OSError:
+            return None
+
+        stamp = (st.st_mtime_ns, st.st_size)
+
+        with self._lock:
+            entry = self._entries.get(key)
+
+            if entry is not None and entry[0] == stamp:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            self.misses += 1
+
+        try:
+            value = load()
+
+        except OSError:
+            return None
+
+        with self._lock:
+            self._entries[key] = (stamp, value)
+            self._entries.move_to_end(key)
+
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'entries': len(self._entries),
+            'size': self.size,
+        }
@@ -15,6 +15,7 @@ class PartDownloadForm(forms.Form):
     def __init__(self, *args, **kwargs):
         self.part = kwargs.pop('part')
         self.user = kwargs.pop('user')
+        self.accessible = kwargs.pop('accessible')
         self.was_marked = kwargs['initial']['download']
 
         super(PartDownloadForm, self).__init__(*args, **kwargs)
@@ -22,35 +23,6 @@ class PartDownloadForm(forms.Form):
     def is_marked(self):
         return self.cleaned_data['download']
 
-    def get_part_model(self):
-        return PartModel.objects.get_or_create(
-            ds_name=self.part.dir.ds.name,
-            dir_path=self.part.dir.full_path,
-            name=self.part.name,
-        )[0]
-
-    def save(self, batch):
-        is_marked = self.is_marked()
-
-        print('{}: is_marked={}; was={}'.format(self.part.name, is_marked, self.was_marked))
-
-        if is_marked == self.was_marked:
-            return
-
-        if is_marked:
-            PartDownload.objects.create(
-                download_batch=batch,
-                part_model=self.get_part_model(),
-            )
-            return 1
-
-        return PartDownload.objects.filter(
-            download_batch=batch,
-            part_model__ds_name=self.part.dir.ds.name,
-            part_model__dir_path=self.part.dir.full_path,
-            part_model__name=self.part.name,
-        ).delete()[0] * -1
-
 
 class BasePartDownloadFormSet(BaseFormSet):
     def __init__(self, request, d, batch):
@@ -78,21 +50,88 @@ class BasePartDownloadFormSet(BaseFormSet):
         kwargs = super(BasePartDownloadFormSet, self).get_form_kwargs(index)
         kwargs['part'] = self.dir.parts[index]
         kwargs['user'] = self.request.user
+        kwargs['accessible'] = self.can_access(kwargs['part'].type)
         return kwargs
 
     def save(self):
-        self.marked = 0
-        self.unmarked = 0
+        """
+        Mark and unmark changed parts for download using a constant number
+        of queries.
+        """
+        to_mark = []
+        to_unmark = []
+
+        for form in self.forms:
+            is_marked = form.is_marked()
+
+            if is_marked == form.was_marked:
+                continue
+
+            (to_mark if is_marked else to_unmark).append(form.part)
 
         with transaction.atomic():
-            for form in self.forms:
-                ret = form.save(self.batch)
+            self.marked = self._mark(to_mark)
+            self.unmarked = self._unmark(to_unmark)
 
-                if ret == 1:
-                    self.marked += 1
+    def _mark(self, parts):
+        if not parts:
+            return 0
 
-                elif ret == -1:
-                    self.unmarked += 1
+        part_models = self._part_models(parts)
+        missing = [
+            PartModel(ds_name=self.dir.ds.name, dir_path=self.dir.full_path, name=part.name)
+            for part in parts if part.name not in part_models
+        ]
+
+        if missing:
+            for pm in missing:
+                pm.hash = pm.make_hash()
+
+            PartModel.objects.bulk_create(missing, ignore_conflicts=True)
+            part_models = self._part_models(parts)
+
+        # Parts can be marked in the meantime, e.g. from another window
+        existing = set(PartDownload.objects.filter(
+            download_batch=self.batch,
+            part_model__in=part_models.values(),
+        ).values_list('part_model_id', flat=True))
+        downloads = [
+            PartDownload(
+                download_batch=self.batch,
+                part_model=part_models[part.name],
+                size=part.size,
+                mtime=part.mtime,
+            ) for part in parts if part_models[part.name].pk not in existing
+        ]
+
+        PartDownload.objects.bulk_create(downloads, ignore_conflicts=True)
+        return len(downloads)
+
+    def _unmark(self, parts):
+        if not parts:
+            return 0
+
+        return PartDownload.objects.filter(
+            pk__in=[self.marked_parts[part.name].pk for part in parts]
+        ).delete()[0]
+
+    def _part_models(self, parts):
+        return {
+            pm.name: pm
+            for pm in PartModel.objects.filter(
+                ds_name=self.dir.ds.name,
+                dir_path=self.dir.full_path,
+                name__in=[part.name for part in parts],
+            )
+        }
+
+    @cached_property
+    def can_access(self):
+        """
+        Function testing accessibility of part types for the current user,
+        see :meth:`zwp.models.PartAcl.predicate`.
+        """
+        return self.request.user.part_acl.predicate(self.dir.ds)
 
     @cached_property
     def marked_count(self):
@@ -0,0 +1,69 @@
+from django.core.management.base import BaseCommand
+import time
+import tracemalloc
+from zwp.models import Part
+
+
+class Command(BaseCommand):
+    help = 'Measure time and memory needed to create parts of a large directory'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--parts',
+            type=int,
+            default=60000,
+            help='Number of parts, five sixths of them are versioned'
+        )
+        parser.add_argument(
+            '--repeat',
+            type=int,
+            default=5,
+            help='Number of timed runs, the best one is reported'
+        )
+
+    def handle(self, *args, **options):
+        names = part_names(options['parts'])
+        times = []
+
+        for _ in range(max(1, options['repeat'])):
+            start = time.perf_counter()
+            make_parts(names)
+            times.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        parts = make_parts(names)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        self.stdout.write('{} parts: {:.2f} s, {:.1f} MB ({} B/part)'.format(
+            len(parts),
+            min(times),
+            size / 1024 / 1024,
+            size // len(parts)
+        ))
+
+
+def part_names(n):
+    """
+    Return ``n`` part names, five sixths of them versioned parts with three
+    versions each, the rest other files.
+    """
+    versioned = n * 5 // 6
+
+    return [
+        'part-{:06d}.prt.{}'.format(i // 3, i % 3 + 1) for i in range(versioned)
+    ] + [
+        'doc-{:06d}.pdf'.format(i) for i in range(n - versioned)
+    ]
+
+
+def make_parts(names):
+    """
+    Create parts with ``names`` and read attributes parsed from the names.
+    """
+    parts = [Part(None, name) for name in names]
+
+    for p in parts:
+        p.type, p.version, p.base_name, p.version_name
+
+    return parts
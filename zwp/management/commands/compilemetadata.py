@@ -0,0 +1,65 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+import os
+from zwp.models import DataSource, Directory
+from zwp.metadata import Metadata
+from zwp.settings import ZWP_METADATA_DIR, ZWP_METADATA_FILE, ZWP_METADATA_COMPILED_FILE
+
+
+class Command(BaseCommand):
+    help = 'Compile metadata files of all directories for faster loading'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--delete',
+            action='store_true',
+            help='Delete compiled metadata files instead'
+        )
+
+    def handle(self, *args, **options):
+        if not ZWP_METADATA_COMPILED_FILE:
+            raise CommandError(
+                'Compiled metadata are disabled, set ZWP_METADATA_COMPILED_FILE first'
+            )
+
+        for opts in settings.ZWP_DATA_SOURCES:
+            ds = DataSource(opts)
+            done = 0
+            failed = 0
+
+            for root, dirs, files in os.walk(ds.path):
+                dirs[:] = [d for d in dirs if d != ZWP_METADATA_DIR]
+                meta_dir = os.path.join(root, ZWP_METADATA_DIR)
+
+                if options['delete']:
+                    compiled_path = os.path.join(meta_dir, ZWP_METADATA_COMPILED_FILE)
+
+                    if os.path.exists(compiled_path):
+                        os.unlink(compiled_path)
+                        done += 1
+
+                    continue
+
+                if not os.path.exists(os.path.join(meta_dir, ZWP_METADATA_FILE)):
+                    continue
+
+                path = os.path.relpath(root, ds.path)
+                d = Directory._from_path(ds.name, '' if path == '.' else path)
+
+                try:
+                    Metadata(d, use_compiled=False).write_compiled()
+                    done += 1
+
+                except Exception as e:
+                    self.stderr.write('Unable to compile metadata of {}: {}'.format(root, e))
+                    failed += 1
+
+            if options['delete']:
+                self.stdout.write('{}: deleted {} files'.format(ds.name, done))
+
+            else:
+                self.stdout.write('{}: compiled {} directories, {} failed'.format(
+                    ds.name,
+                    done,
+                    failed
+                ))
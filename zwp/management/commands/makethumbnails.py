@@ -0,0 +1,109 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from django.db import connections
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import os
+from zwp.models import DataSource, Directory
+from zwp.settings import ZWP_METADATA_DIR, ZWP_THUMBNAIL_BACKEND
+from zwp.thumbnails import get_thumbnailer, generate_easy_thumbnail
+
+
+class Command(BaseCommand):
+    help = 'Generate missing or outdated part thumbnails for the easy_thumbnails backend'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'data_source',
+            nargs='*',
+            help='Names of data sources, defaults to all'
+        )
+        parser.add_argument(
+            '--jobs',
+            type=int,
+            default=os.cpu_count() or 1,
+            help='Number of processes generating thumbnails'
+        )
+
+    def handle(self, *args, **options):
+        if ZWP_THUMBNAIL_BACKEND != 'zwp.thumbnails.easy_thumbnails':
+            raise CommandError(
+                'Thumbnails are generated only by the easy_thumbnails backend, '
+                'set ZWP_THUMBNAIL_BACKEND first'
+            )
+
+        if get_thumbnailer is None:
+            raise CommandError('easy_thumbnails is not installed')
+
+        data_sources = [DataSource(opts) for opts in settings.ZWP_DATA_SOURCES]
+
+        if options['data_source']:
+            names = [ds.name for ds in data_sources]
+
+            for name in options['data_source']:
+                if name not in names:
+                    raise CommandError('Data source "%s" does not exist' % name)
+
+            data_sources = [ds for ds in data_sources if ds.name in options['data_source']]
+
+        for ds in data_sources:
+            thumbnails = self.find_thumbnails(ds)
+            self.stdout.write('{}: found {} thumbnails'.format(ds.name, len(thumbnails)))
+            self.generate(ds, thumbnails, options)
+
+    def find_thumbnails(self, ds):
+        """
+        Return a sorted list of thumbnails of all parts in data source ``ds``,
+        including thumbnails from included paths, relative to the data source.
+        """
+        ret = set()
+
+        for root, dirs, files in os.walk(ds.path):
+            dirs[:] = [d for d in dirs if d != ZWP_METADATA_DIR]
+            path = os.path.relpath(root, ds.path)
+
+            try:
+                d = Directory._from_path(ds.name, '' if path == '.' else path, load=True)
+                ret.update(p.thumbnail for p in d.parts if p.thumbnail)
+
+            except Exception as e:
+                self.stderr.write('Unable to load {}: {}'.format(root, e))
+
+        return sorted(ret)
+
+    def generate(self, ds, thumbnails, options):
+        generated = 0
+        failed = 0
+        total = len(thumbnails)
+
+        # Worker processes open their own database connections
+        connections.close_all()
+
+        with ProcessPoolExecutor(max_workers=max(1, options['jobs'])) as pool:
+            futures = {
+                pool.submit(generate_easy_thumbnail, ds.name, path): path
+                for path in thumbnails
+            }
+
+            for i, future in enumerate(as_completed(futures), 1):
+                path = futures[future]
+
+                try:
+                    if future.result():
+                        generated += 1
+
+                        if options['verbosity'] > 1:
+                            self.stdout.write('Generated {}'.format(path))
+
+                except Exception as e:
+                    self.stderr.write('Unable to generate thumbnail of {}: {}'.format(path, e))
+                    failed += 1
+
+                if options['verbosity'] > 0 and (i % 100 == 0 or i == total):
+                    self.stdout.write('{}: {}/{} processed'.format(ds.name, i, total))
+
+        self.stdout.write('{}: generated {} thumbnails, {} up to date, {} failed'.format(
+            ds.name,
+            generated,
+            total - generated - failed,
+            failed
+        ))
@@ -0,0 +1,50 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+from zwp.models import DataSource
+from zwp.catalog import get_catalog
+
+
+class Command(BaseCommand):
+    help = 'Update the catalog of data source contents'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'data_source',
+            nargs='*',
+            help='Names of data sources to scan, defaults to all'
+        )
+        parser.add_argument(
+            '--full',
+            action='store_true',
+            help='Rescan all directories, not only those that have changed'
+        )
+
+    def handle(self, *args, **options):
+        catalog = get_catalog()
+
+        if catalog is None:
+            raise CommandError('The catalog is disabled, set ZWP_CATALOG first')
+
+        data_sources = [DataSource(opts) for opts in settings.ZWP_DATA_SOURCES]
+
+        if options['data_source']:
+            names = [ds.name for ds in data_sources]
+
+            for name in options['data_source']:
+                if name not in names:
+                    raise CommandError('Data source "%s" does not exist' % name)
+
+            data_sources = [ds for ds in data_sources if ds.name in options['data_source']]
+
+        for ds in data_sources:
+            stats = catalog.scan(ds, full=options['full'])
+
+            self.stdout.write(
+                '{}: scanned {} directories, updated {}, removed {}, refreshed {} files'.format(
+                    ds.name,
+                    stats['scanned'],
+                    stats['updated'],
+                    stats['removed'],
+                    stats['refreshed']
+                )
+            )
@@ -0,0 +1,119 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.conf import settings
+import os
+from zwp.models import DataSource
+from zwp.cache import invalidate_path, dir_of_path
+from zwp.catalog import get_catalog
+
+try:
+    from inotify_simple import INotify, flags
+
+except ImportError:
+    INotify = None
+
+
+class Command(BaseCommand):
+    help = 'Watch data sources for changes and invalidate affected caches'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--delay',
+            type=int,
+            default=500,
+            help='Milliseconds to wait for more events before invalidating caches'
+        )
+
+    def handle(self, *args, **options):
+        if INotify is None:
+            raise CommandError('inotify_simple is required to watch data sources')
+
+        self.inotify = INotify()
+        self.watch_flags = flags.CREATE | flags.DELETE | flags.CLOSE_WRITE | \
+            flags.MOVED_FROM | flags.MOVED_TO | flags.DELETE_SELF
+        self.watches = {}  # wd: (ds, path)
+        self.catalog = get_catalog()
+        self.verbosity = options['verbosity']
+
+        for opts in settings.ZWP_DATA_SOURCES:
+            ds = DataSource(opts)
+            self.stdout.write('{}: watching {} directories'.format(
+                ds.name,
+                self.watch_tree(ds, '')
+            ))
+
+        while True:
+            self.process(self.inotify.read(read_delay=options['delay']))
+
+    def process(self, events):
+        changed = set()
+
+        for event in events:
+            if event.mask & flags.Q_OVERFLOW:
+                # Events were lost, consider everything changed
+                changed.update(self.watches.values())
+                continue
+
+            if event.wd not in self.watches:
+                continue
+
+            ds, path = self.watches[event.wd]
+
+            if event.mask & flags.IGNORED:
+                del self.watches[event.wd]
+                continue
+
+            changed.add((ds, path))
+
+            if not event.mask & flags.ISDIR:
+                continue
+
+            if event.mask & (flags.CREATE | flags.MOVED_TO):
+                self.watch_tree(ds, os.path.join(path, event.name))
+
+            elif event.mask & (flags.DELETE | flags.MOVED_FROM):
+                removed = os.path.join(path, event.name)
+                changed.add((ds, removed))
+                self.unwatch_tree(ds, removed)
+
+        for ds, path in changed:
+            if self.verbosity > 1:
+                self.stdout.write('{}: invalidating {}'.format(ds.name, path or '/'))
+
+            invalidate_path(ds.name, path)
+
+            if self.catalog is not None:
+                self.catalog.update(ds, dir_of_path(path))
+
+    def watch_tree(self, ds, path):
+        n = 0
+
+        for root, dirs, files in os.walk(os.path.join(ds.path, path)):
+            rel_path = os.path.relpath(root, ds.path)
+
+            try:
+                wd = self.inotify.add_watch(root, self.watch_flags)
+
+            except OSError as e:
+                self.stderr.write('Unable to watch {}: {}'.format(root, e))
+                continue
+
+            self.watches[wd] = (ds, '' if rel_path == '.' else rel_path)
+            n += 1
+
+        return n
+
+    def unwatch_tree(self, ds, path):
+        for wd, (watched_ds, watched_path) in list(self.watches.items()):
+            if watched_ds is not ds:
+                continue
+
+            if watched_path != path and not watched_path.startswith(path + os.sep):
+                continue
+
+            try:
+                self.inotify.rm_watch(wd)
+
+            except OSError:
+                pass  # already removed by the kernel
+
+            del self.watches[wd]
@@ -0,0 +1,126 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+import time
+from zwp.models import DownloadBatch
+from zwp.cache import clear_zip_progress
+from zwp.zipbuild import build_zip
+from zwp.settings import ZWP_DOWNLOAD_WORKERS, ZWP_DOWNLOAD_CLAIM_TIMEOUT
+
+
+class Command(BaseCommand):
+    help = 'Create ZIP files of download batches queued with ZWP_DOWNLOAD_QUEUE enabled'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=ZWP_DOWNLOAD_WORKERS,
+            help='Number of ZIP files created at the same time'
+        )
+        parser.add_argument(
+            '--interval',
+            type=float,
+            default=1.0,
+            help='Seconds between checks for queued batches'
+        )
+        parser.add_argument(
+            '--claim-timeout',
+            type=float,
+            default=ZWP_DOWNLOAD_CLAIM_TIMEOUT,
+            help='Seconds after which batches claimed by stopped workers are queued again'
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Exit when there are no queued batches'
+        )
+
+    def handle(self, *args, **options):
+        concurrency = max(1, options['concurrency'])
+        self.verbosity = options['verbosity']
+        self.claim_timeout = timedelta(seconds=options['claim_timeout'])
+        running = {}  # future: batch pk
+        renewed = time.monotonic()
+
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            while True:
+                running = {f: pk for f, pk in running.items() if not f.done()}
+
+                # Claims are renewed well before they expire
+                if running and time.monotonic() - renewed >= options['claim_timeout'] / 3:
+                    self.renew(running.values())
+                    renewed = time.monotonic()
+
+                for batch in self.claim(concurrency - len(running)):
+                    running[pool.submit(self.build, batch)] = batch.pk
+
+                if options['once'] and not running:
+                    break
+
+                time.sleep(options['interval'])
+
+    def claim(self, n):
+        """
+        Return up to ``n`` queued batches, which are marked as started,
+        so that they are not taken by other workers. Batches whose claim
+        has expired are queued again first.
+        """
+        if n <= 0:
+            return []
+
+        expired = list(DownloadBatch.objects.filter(
+            state=DownloadBatch.PREPARING,
+            started_at__lt=timezone.now() - self.claim_timeout
+        ).values_list('pk', flat=True))
+
+        if expired:
+            DownloadBatch.objects.filter(
+                pk__in=expired,
+                started_at__lt=timezone.now() - self.claim_timeout
+            ).update(started_at=None)
+
+            for pk in expired:
+                clear_zip_progress(pk)
+
+            self.stderr.write('Queued {} batches with expired claims again'.format(len(expired)))
+
+        ret = []
+        queued = DownloadBatch.objects.filter(
+            state=DownloadBatch.PREPARING,
+            started_at__isnull=True
+        ).order_by('pk').values_list('pk', flat=True)[0:n]
+
+        for pk in queued:
+            now = timezone.now()
+            claimed = DownloadBatch.objects.filter(
+                pk=pk,
+                started_at__isnull=True
+            ).update(started_at=now)
+
+            if claimed:
+                ret.append(DownloadBatch.objects.get(pk=pk))
+
+        return ret
+
+    def renew(self, pks):
+        DownloadBatch.objects.filter(
+            pk__in=list(pks),
+            state=DownloadBatch.PREPARING
+        ).update(started_at=timezone.now())
+
+    def build(self, batch):
+        try:
+            if self.verbosity > 1:
+                self.stdout.write('Creating {}'.format(batch))
+
+            build_zip(batch)
+
+        except Exception as e:
+            self.stderr.write('{}: {}'.format(batch, e))
+
+        finally:
+            # Each thread has its own database connection
+            connection.close()
@@ -1,12 +1,63 @@
 from django.core.exceptions import PermissionDenied
+from django.utils.functional import cached_property
 import os
 import configparser
+import json
 import pam
 from .settings import ZWP_METADATA_DIR, ZWP_METADATA_FILE, ZWP_USERS_FILE, ZWP_ACL_FILE, \
-                      ZWP_PART_THUMBNAIL_DIR
+                      ZWP_PART_THUMBNAIL_DIR, ZWP_CONFIG_CACHE_SIZE, ZWP_METADATA_COMPILED_FILE
+from .filecache import FileCache
 from .signals import part_meta_load
 
 
+class ConfigCache(FileCache):
+    """
+    Process-wide LRU cache of parsed config files, see :class:`FileCache`.
+    Entries are keyed by file path and interpolation.
+
+    Cached parsers are shared and must not be modified.
+    """
+    def get(self, path, interpolation=True):
+        """
+        Return :class:`configparser.ConfigParser` with contents of file at
+        ``path``, or ``None`` if the file does not exist. If ``interpolation``
+        is false, values are not interpolated.
+        """
+        return self.lookup(
+            path,
+            (path, bool(interpolation)),
+            lambda: self._parse(path, interpolation)
+        )
+
+    def _parse(self, path, interpolation):
+        if interpolation:
+            cfg = configparser.ConfigParser()
+
+        else:
+            cfg = configparser.ConfigParser(interpolation=None)
+
+        cfg.read(path)
+        return cfg
+
+
+config_cache = ConfigCache(ZWP_CONFIG_CACHE_SIZE)
+
+
+def catalog_config(d, name, directory=False):
+    """
+    Return contents of config file ``name`` of directory ``d`` from
+    the catalog, see :meth:`zwp.catalog.Catalog.config`.
+    """
+    from .catalog import get_catalog
+
+    catalog = get_catalog()
+
+    if catalog is None:
+        return None
+
+    return catalog.config(d.ds.name, d.full_path, name, directory=directory)
+
+
 class Parameter:
     def __init__(self, lang, handle):
         self._lang = lang
@@ -29,21 +80,108 @@ class Parameter:
 
 
 class Metadata:
-    def __init__(self, d):
+    """
+    Metadata of directory ``d``. They are read from the catalog, if it
+    contains the directory, otherwise from the compiled metadata file, if
+    enabled and up to date, or from the metadata file itself.
+    """
+    # Version of the compiled metadata format, compiled files with a different
+    # version are ignored
+    COMPILED_VERSION = 1
+
+    def __init__(self, d, use_compiled=True):
         from .utils import short_lang
 
         self._dir = d
         self._path = os.path.join(d.data_path, ZWP_METADATA_DIR, ZWP_METADATA_FILE)
+        self._compiled_path = ZWP_METADATA_COMPILED_FILE and os.path.join(
+            d.data_path,
+            ZWP_METADATA_DIR,
+            ZWP_METADATA_COMPILED_FILE
+        )
         self._lang = short_lang()
         self._data_includes = []
+        self._use_compiled = use_compiled and ZWP_METADATA_COMPILED_FILE
+        self._compiled = None
+        self._partial = False
+        self.cfg = None
         self.thumbnail_paths = [os.path.join(d.data_path, ZWP_PART_THUMBNAIL_DIR)]
 
+    @cached_property
+    def _catalog_directory(self):
+        return catalog_config(self._dir, ZWP_METADATA_FILE, directory=True)
+
+    @cached_property
+    def _catalog_data(self):
+        return catalog_config(self._dir, ZWP_METADATA_FILE)
+
     def exists(self):
+        if self._catalog_directory is not None:
+            return self._catalog_directory is not False
+
         return os.path.exists(self._path)
 
+    def read(self):
+        """
+        Read the metadata file without resolving included files.
+        """
+        if (self.cfg is not None and not self._partial) or self._compiled is not None:
+            return
+
+        data = self._catalog_data
+
+        # Compiled metadata were already checked by read_directory()
+        if data is None and self._use_compiled and not self._partial:
+            self._compiled = self._load_compiled()
+
+            if self._compiled is not None:
+                return
+
+        self._partial = False
+
+        if data is not None:
+            self.cfg = configparser.ConfigParser(interpolation=None)
+            self.cfg.read_dict(data or {})
+
+        else:
+            self.cfg = config_cache.get(self._path, interpolation=False) or \
+                       configparser.ConfigParser(interpolation=None)
+
+    def read_directory(self):
+        """
+        Read only the ``Directory`` section of the metadata file, which holds
+        the label. Large sections with part data are not parsed, the whole
+        file is read by :meth:`read` when needed.
+        """
+        if self.cfg is not None or self._compiled is not None:
+            return
+
+        data = self._catalog_directory
+
+        if data is None and self._use_compiled:
+            self._compiled = self._load_compiled()
+
+            if self._compiled is not None:
+                return
+
+        self._partial = True
+
+        if data is not None:
+            self.cfg = configparser.ConfigParser(interpolation=None)
+            self.cfg.read_dict(data or {})
+
+        else:
+            self.cfg = read_section(self._path, 'Directory')
+
     def parse(self):
-        self.cfg = configparser.ConfigParser(interpolation=None)
-        self.cfg.read(self._path)
+        self.read()
+
+        if self._compiled is not None:
+            self.thumbnail_paths = [
+                os.path.join(self._dir.data_path, p)
+                for p in self._compiled['thumbnail_paths']
+            ]
+            return self._compiled['has_data']
 
         from .models import Directory
 
@@ -52,7 +190,7 @@ class Metadata:
                 self._dir.ds.name,
                 self._resolve_path(x.strip()),
                 user=self._dir.user
-            ))
+            ), use_compiled=self._use_compiled)
             meta.parse()
             return meta
 
@@ -69,15 +207,39 @@ class Metadata:
 
     @property
     def label(self):
-        label_opt = 'Label/{}'.format(self._lang)
+        return self.labels.get(self._lang)
 
-        if self.cfg.has_option('Directory', label_opt):
-            return self.cfg['Directory'][label_opt].replace('"', '')
+    @property
+    def labels(self):
+        """
+        Directory labels of all languages, as a dictionary of language codes
+        and labels.
+        """
+        if self._compiled is not None:
+            return dict(self._compiled['labels'])
 
-        return None
+        if not self.cfg.has_section('Directory'):
+            return {}
+
+        return {
+            opt.split('/', 1)[1]: self.cfg['Directory'][opt].replace('"', '')
+            for opt in self.cfg.options('Directory')
+            if opt.startswith('label/')
+        }
 
     @property
     def columns(self):
+        if self._compiled is not None:
+            ret = []
+
+            for handle, type, labels in self._compiled['columns']:
+                p = Parameter(self._lang, handle)
+                p.type = type
+                p._labels = labels
+                ret.append(p)
+
+            return ret
+
         cols = {}
 
         for meta in self._data_includes:
@@ -89,12 +251,86 @@ class Metadata:
 
     @property
     def parts_data(self):
+        if self._compiled is not None:
+            parts = self._compiled['parts']
+            return parts.get(self._lang, parts[''])
+
+        return self._merge_parts_data(self._lang)
+
+    def compile(self):
+        """
+        Return parsed metadata with resolved includes as a dictionary that
+        can be serialized to JSON. Part data are resolved for all languages
+        found in the files, key ``''`` holds data for other languages.
+
+        Paths are relative to the directory, so that compiled files remain
+        valid when the data source is moved.
+        """
+        has_data = bool(self.parse())
+
+        metas = [self] + self._data_includes
+        langs = {''}
+
+        for meta in metas:
+            langs.update(meta._part_langs())
+
+        return {
+            'version': self.COMPILED_VERSION,
+            'sources': [
+                [os.path.relpath(meta._path, self._dir.data_path), _file_stamp(meta._path)]
+                for meta in metas
+            ],
+            'has_data': has_data,
+            'labels': self.labels,
+            'thumbnail_paths': [
+                os.path.relpath(p, self._dir.data_path) for p in self.thumbnail_paths
+            ],
+            'columns': [[p.handle, p.type, p._labels] for p in self.columns] if has_data else [],
+            'parts': {
+                lang: self._merge_parts_data(lang) for lang in langs
+            } if has_data else {'': {}},
+        }
+
+    def write_compiled(self):
+        """
+        Compile metadata and save them next to the metadata file.
+        """
+        data = self.compile()
+        tmp_path = self._compiled_path + '.tmp'
+
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f, separators=(',', ':'))
+
+        os.replace(tmp_path, self._compiled_path)
+
+    def _load_compiled(self):
+        """
+        Return compiled metadata if they exist and are up to date with all
+        source files, otherwise return ``None``.
+        """
+        try:
+            with open(self._compiled_path) as f:
+                data = json.load(f)
+
+        except (OSError, ValueError):
+            return None
+
+        if data.get('version') != self.COMPILED_VERSION:
+            return None
+
+        for path, stamp in data['sources']:
+            if _file_stamp(os.path.join(self._dir.data_path, path)) != stamp:
+                return None
+
+        return data
+
+    def _merge_parts_data(self, lang):
         data = {}
 
         for meta in self._data_includes:
-            data.update(meta._parse_parts_data())
+            data.update(meta._parse_parts_data(lang))
 
-        data.update(self._parse_parts_data())
+        data.update(self._parse_parts_data(lang))
 
         return data
 
@@ -128,7 +364,20 @@ class Metadata:
 
         return params
 
-    def _parse_parts_data(self):
+    def _part_langs(self):
+        if not self.cfg.has_section('Parts'):
+            return set()
+
+        return {
+            components[2]
+            for components in map(self._parse_opt, self.cfg.options('Parts'))
+            if len(components) == 3
+        }
+
+    def _parse_parts_data(self, current_lang=None):
+        if current_lang is None:
+            current_lang = self._lang
+
         ret = {}
 
         if not self.cfg.has_section('Parts'):
@@ -152,7 +401,7 @@ class Metadata:
 
                 ret[part] = opts
 
-            if lang == self._lang or param not in ret[part]:
+            if lang == current_lang or param not in ret[part]:
                 ret[part][param] = self.cfg['Parts'][raw_opt]
 
         return ret
@@ -175,18 +424,59 @@ class Metadata:
         return [parts[0]]
 
 
+def read_section(path, section):
+    """
+    Return :class:`configparser.ConfigParser` without interpolation with only
+    ``section`` of INI file at ``path``. Reading stops at the end of the section.
+    """
+    cfg = configparser.ConfigParser(interpolation=None)
+    lines = []
+    seen = False
+    keep = False
+
+    try:
+        with open(path) as f:
+            for line in f:
+                m = None if line[0:1].isspace() else cfg.SECTCRE.match(line.strip())
+
+                if m is not None:
+                    header = m.group('header')
+
+                    if header == section:
+                        seen = True
+
+                    elif seen and header != cfg.default_section:
+                        break
+
+                    keep = header in (section, cfg.default_section)
+
+                if keep:
+                    lines.append(line)
+
+    except OSError:
+        return cfg
+
+    cfg.read_string(''.join(lines), path)
+    return cfg
+
+
+def _file_stamp(path):
+    try:
+        st = os.stat(path)
+
+    except OSError:
+        return None
+
+    return [st.st_mtime_ns, st.st_size]
+
+
 class Users:
     def __init__(self, ds):
         self._path = os.path.join(ds.path, ZWP_METADATA_DIR, ZWP_USERS_FILE)
         self.parse()
 
     def parse(self):
-        if os.path.exists(self._path):
-            self.cfg = configparser.ConfigParser()
-            self.cfg.read(self._path)
-
-        else:
-            self.cfg = None
+        self.cfg = config_cache.get(self._path)
 
     def authenticate(self, username, password):
         if self.cfg is None or not self.cfg.has_section(username):
@@ -218,27 +508,36 @@ class Users:
 
 class Acl:
     def __init__(self, d):
+        self._dir = d
         self._path = os.path.join(d.data_path, ZWP_METADATA_DIR, ZWP_ACL_FILE)
 
+    @cached_property
+    def _catalog_data(self):
+        return catalog_config(self._dir, ZWP_ACL_FILE)
+
     def exists(self):
+        if self._catalog_data is not None:
+            return self._catalog_data is not False
+
         return os.path.exists(self._path)
 
     def parse(self):
-        self.cfg = configparser.ConfigParser()
-        self.cfg.read(self._path)
+        if self._catalog_data:
+            self.cfg = configparser.ConfigParser()
+            self.cfg.read_dict(self._catalog_data)
+
+        else:
+            self.cfg = config_cache.get(self._path) or configparser.ConfigParser()
 
         return True
 
-    def is_accessible(self, user):
+    def allowed_users(self):
+        """
+        Return a set of user names that can access the directory, or ``None``
+        if the directory is accessible to everyone.
+        """
         if self.cfg.has_section('allow'):
             if self.cfg.has_option('allow', 'users'):
-                if user is None:
-                    return False
+                return frozenset(self.cfg['allow']['users'].split(','))
 
-                elif user.username in self.cfg['allow']['users'].split(','):
-                    return True
-
-                else:
-                    return False
-
-        return True
+        return None
@@ -1,6 +1,4 @@
-from django.conf import settings
-from zwp.metadata import Users
-from zwp.models import DataSource, PartAcl
+from zwp.models import PartAcl
 
 
 class PartAccessMiddleware:
@@ -8,20 +6,14 @@ class PartAccessMiddleware:
         self.get_response = get_response
 
     def __call__(self, request):
-        part_acl = PartAcl()
-
         if request.user.is_authenticated:
             username = request.user.username
 
         else:
             username = None
 
-        for opts in settings.ZWP_DATA_SOURCES:
-            ds = DataSource(opts)
-            u = Users(ds)
-            part_acl.add(ds, list(u.get_parts(username)))
-
-        request.user.part_acl = part_acl
+        # Rules are resolved lazily, only for data sources that are accessed
+        request.user.part_acl = PartAcl(username)
 
         response = self.get_response(request)
         return response
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zwp', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='downloadbatch',
+            name='started_at',
+            field=models.DateTimeField(verbose_name='started at', null=True),
+        ),
+    ]
@@ -0,0 +1,16 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zwp', '0002_downloadbatch_started_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='downloadbatch',
+            name='content_key',
+            field=models.CharField(verbose_name='content key', max_length=64, null=True, db_index=True),
+        ),
+    ]
@@ -0,0 +1,21 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zwp', '0003_downloadbatch_content_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='partdownload',
+            name='size',
+            field=models.BigIntegerField(verbose_name='size', null=True),
+        ),
+        migrations.AddField(
+            model_name='partdownload',
+            name='mtime',
+            field=models.FloatField(verbose_name='modification time', null=True),
+        ),
+    ]
@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('zwp', '0004_partdownload_size_mtime'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='partmodel',
+            index=models.Index(fields=['ds_name', 'dir_path', 'name'], name='zwp_partmod_ds_name_30e51a_idx'),
+        ),
+    ]
@@ -5,8 +5,9 @@ from django.utils.translation import ugettext_lazy as _
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.utils.functional import cached_property
+from django.utils import timezone
 from django.core.cache import cache
-from django.core.cache.utils import make_template_fragment_key
+import copy
 import hashlib
 import os
 import sys
@@ -15,10 +16,24 @@ import re
 import random
 import string
 from .metadata import Users, Metadata, Acl
+from .catalog import get_catalog
+from .cache import dir_instance_key, dir_state_key, clear_zip_progress
 from .settings import *
 
 
 class DataSource(object):
+    @staticmethod
+    def from_name(name):
+        """
+        Return data source ``name`` from ``ZWP_DATA_SOURCES``, or ``None``
+        if it does not exist.
+        """
+        for opts in settings.ZWP_DATA_SOURCES:
+            if opts['name'] == name:
+                return DataSource(opts)
+
+        return None
+
     def __init__(self, opts):
         self._opts = opts
 
@@ -42,6 +57,14 @@ class DataSource(object):
     def static_url(self):
         return self._opts.get('static_url', None)
 
+    @property
+    def compression(self):
+        return self._opts.get('compression', ZWP_DOWNLOAD_COMPRESSION)
+
+    @property
+    def compresslevel(self):
+        return self._opts.get('compresslevel', ZWP_DOWNLOAD_COMPRESSLEVEL)
+
 
 class Item(object):
     def __init__(self, ds, path, name, root=False, user=None):
@@ -107,65 +130,187 @@ class Item(object):
 
 
 class Directory(Item):
+    """
+    Directories are cached as snapshots shared by all users and languages.
+    :meth:`from_path` returns a shallow copy bound to a user by :meth:`bind`,
+    which filters children by their ACL. Children and parts are shared with
+    the snapshot and are not bound to any user, accessibility of parts is
+    evaluated by :meth:`PartAcl.predicate`.
+
+    Snapshots are not pickled into the cache as they are, but converted
+    to compact records, see :meth:`to_record`. Each snapshot has a random
+    :attr:`content_stamp`, which changes whenever the snapshot is read from
+    the file system. Caches of content rendered from the snapshot are keyed
+    by the stamp.
+    """
+    # Version of cache records, records with a different version are ignored
+    CACHE_VERSION = 4
+
     @staticmethod
-    def get(ds, path, name, user=None, **kwargs):
+    def from_path(ds_name, path, user=None, load=False, **kwargs):
         """
-        This method is used instead of the constructor, as it does not create a new object
-        when it's already in cache.
+        Cached version of ``from_path``.
+        """
+        key = dir_instance_key(ds_name, path)
+        v = Directory._cache_get(key)
+
+        if v:
+            print('from_path: cache hit for ds={}; dir={}'.format(ds_name, path))
+
+            if load and not v.loaded:
+                v.load()
+                Directory._cache_set(key, v)
+
+            return v.bind(user)
+
+        d = Directory._from_path(ds_name, path, load=load, **kwargs)
+        print('cache miss for ds={}; dir={}'.format(ds_name, path))
+
+        if not d:
+            return d
+
+        Directory._cache_set(key, d)
+        return d.bind(user)
+
+    @staticmethod
+    def cached_state(ds_name, path):
+        """
+        Return a tuple of :attr:`content_stamp` and names of allowed users,
+        see :attr:`acl_users`, of directory ``path`` without restoring it
+        from the cache. Returns ``None`` if the directory is not cached.
+        """
+        key = dir_instance_key(ds_name, path)
+        state = cache.get(dir_state_key(key))
+
+        # The snapshot may be evicted before its state, it would be read again
+        # with a different stamp
+        if state is None or not cache.has_key(key):
+            return None
+
+        return state
+
+    @staticmethod
+    def _get(ds, path, name, **kwargs):
+        """
+        Return cached snapshot of directory ``name``, which is not bound
+        to any user.
         """
         full_path = os.path.join(path, name)
 
-        key = make_template_fragment_key(
-            'zwp_dir_instance',
-            [ds.name, full_path, user and user.username]
-        )
-        v = cache.get(key)
+        key = dir_instance_key(ds.name, full_path)
+        v = Directory._cache_get(key)
 
         if v:
-            print('get: cache hit for ds={}; dir={}; user={}'.format(ds.name, full_path, user))
+            print('get: cache hit for ds={}; dir={}'.format(ds.name, full_path))
             return v
 
-        d = Directory(ds, path, name=name, user=user, **kwargs)
-        cache.set(key, d, 60)
-        print('cache miss for ds={}; dir={}; user={}'.format(ds.name, full_path, user))
+        d = Directory(ds, path, name=name, **kwargs)
+        Directory._cache_set(key, d)
+        print('cache miss for ds={}; dir={}'.format(ds.name, full_path))
         return d
 
     @staticmethod
-    def from_path(ds_name, path, user=None, load=False, **kwargs):
+    def _cache_get(key):
+        return Directory.from_record(cache.get(key))
+
+    @staticmethod
+    def _cache_set(key, d):
+        cache.set_many({
+            key: d.to_record(),
+            dir_state_key(key): (d._stamp, d._acl_record()),
+        }, ZWP_DIR_CACHE_TIMEOUT)
+
+    @staticmethod
+    def from_record(record):
         """
-        Cached version of ``from_path``.
+        Reconstruct directory from a record created by :meth:`to_record`.
+        Returns ``None`` if the record is empty, has a different version
+        or its data source no longer exists.
         """
-        key = make_template_fragment_key(
-            'zwp_dir_instance',
-            [ds_name, path, user and user.username]
-        )
-        v = cache.get(key)
+        if not record or record[0] != Directory.CACHE_VERSION:
+            return None
 
-        if v:
-            print('from_path: cache hit for ds={}; dir={}; user={}'.format(ds_name, path, user))
+        _, ds_name, path, name, root, labels, acl_users, stamp, children, parts = record
+        ds = DataSource.from_name(ds_name)
 
-            if load:
-                v.load()
+        if ds is None:
+            return None
 
-            return v
+        d = Directory._restore(ds, path, name, root, labels, acl_users)
+        d._stamp = stamp
+
+        if children is not None:
+            full_path = d.full_path
+            d._children = [
+                Directory._restore(ds, full_path, child_name, False, child_labels, child_acl)
+                for child_name, child_labels, child_acl in children
+            ]
+            d._set_parts([
+                Part(d, part_name, size=size, mtime=mtime)
+                for part_name, size, mtime in parts
+            ])
+            d._loaded = True
 
-        d = Directory._from_path(ds_name, path, user=user, load=load, **kwargs)
-        cache.set(key, d, 60)
-        print('cache miss for ds={}; dir={}; user={}'.format(ds_name, path, user))
         return d
 
+    @staticmethod
+    def _restore(ds, path, name, root=False, labels=None, acl_users=None):
+        d = Directory.__new__(Directory)
+        Item.__init__(d, ds, path, name, root=root)
+        d._init_state()
+        d._labels = labels or {}
+        d._acl_users = None if acl_users is None else frozenset(acl_users)
+        return d
+
+    def to_record(self):
+        """
+        Return a compact representation of this directory as a tuple of plain
+        values, suitable for the cache. Metadata and other lazily loaded state
+        are not included, children are stored only with their labels and ACL.
+        Parts include all versions.
+        """
+        return (
+            self.CACHE_VERSION,
+            self.ds.name,
+            self._path,
+            self._name,
+            self._is_root,
+            self._labels or None,
+            self._acl_record(),
+            self._stamp,
+            tuple(
+                (d._name, d._labels or None, d._acl_record())
+                for d in self._children
+            ) if self._loaded else None,
+            tuple(
+                (p.name, p._size, p._mtime) for p in self._all_parts()
+            ) if self._loaded else None,
+        )
+
+    def _all_parts(self):
+        """
+        Return all parts including older versions, sorted by name.
+        """
+        if not self._versions:
+            return self._parts
+
+        return sorted(
+            [p for p in self._parts if p.type not in ZWP_VERSIONED_PARTS] +
+            [p for versions in self._versions.values() for p in versions],
+            key=lambda p: p.name
+        )
+
+    def _acl_record(self):
+        return None if self._acl_users is None else tuple(sorted(self._acl_users))
+
     @staticmethod
     def _from_path(ds_name, path, load=False, user=None):
         """
         This method does not check the cache and always creates a new instance.
         """
-        ds = None
+        ds = DataSource.from_name(ds_name)
 
-        for opts in settings.ZWP_DATA_SOURCES:
-            if opts['name'] == ds_name:
-                ds = DataSource(opts)
-                break
-        else:
+        if ds is None:
             return False
 
         is_root = not path
@@ -189,18 +334,78 @@ class Directory(Item):
 
     def __init__(self, *args, **kwargs):
         super(Directory, self).__init__(*args, **kwargs)
+        self._init_state()
+        self._load_acl()
+        self._load_label()
+        self._stamp = _new_stamp()
+
+    def _init_state(self):
         self._is_dir = True
         self._loaded = False
         self._icon = None
         self._text_icon = None
         self._indexes = None
         self._parts = []
+        self._versions = {}
         self._columns = []
         self._parts_meta = {}
         self._part_thumbnails = None
+        self._meta_loaded = False
+        self._snapshot = None
+        self._user_children = None
+        self._meta = None
+        self._acl_users = None
+        self._labels = {}
+        self._stamp = None
+
+    def bind(self, user):
+        """
+        Return a copy of this directory for ``user``. The copy shares loaded
+        children, parts and metadata with the snapshot, children are filtered
+        for ``user``.
+        """
+        d = copy.copy(self)
+        d.user = user
+        d._snapshot = self._snapshot or self
+        d._user_children = None
+        return d
 
-        self._load_acl()
-        self._load_metadata()
+    @property
+    def label(self):
+        from .utils import short_lang
+
+        return self._labels.get(short_lang()) or self._name
+
+    @property
+    def accessible(self):
+        return self.is_accessible(self.user)
+
+    @property
+    def acl_users(self):
+        """
+        Names of users allowed to access this directory, or ``None``
+        if the access is not restricted.
+        """
+        return self._acl_users
+
+    def is_accessible(self, user):
+        return Directory.acl_allows(self._acl_users, user)
+
+    @staticmethod
+    def acl_allows(acl_users, user):
+        """
+        Return ``True`` if ``user`` can access a directory with allowed users
+        ``acl_users``, see :attr:`acl_users`. Used also with ACLs of cached
+        directories, which are not restored.
+        """
+        if acl_users is None:
+            return True
+
+        return user is not None and user.username in acl_users
+
+    @property
+    def loaded(self):
+        return self._loaded
 
     @cached_property
     def data_path(self):
@@ -214,6 +419,10 @@ class Directory(Item):
     def is_root(self):
         return self._is_root
 
+    @property
+    def content_stamp(self):
+        return self._stamp
+
     @cached_property
     def icon(self):
         if self._icon is False or self._icon:
@@ -235,55 +444,92 @@ class Directory(Item):
         if not self._loaded:
             self.load()
 
+        # Children are shared snapshots, they are not bound to the user
+        if self._user_children is None:
+            self._user_children = [
+                d for d in self._children if d.is_accessible(self.user)
+            ]
+
+        return self._user_children
+
+    def all_children(self):
+        """
+        Return all children, including inaccessible ones, as snapshots
+        not bound to any user.
+        """
+        if not self._loaded:
+            self.load()
+
         return self._children
 
     @cached_property
     def has_children(self):
+        """
+        Whether the directory has any subdirectories, including inaccessible
+        ones. Nodes of the directory tree are shared by all users, so this
+        must not depend on the user or on whether the directory is loaded.
+        """
         if self._loaded:
             return len(self._children) > 0
 
-        for f in os.listdir(self.data_path):
-            if f != ZWP_METADATA_DIR and os.path.isdir(os.path.join(self.data_path, f)):
-                return True
+        entries = self._catalog_entries()
+
+        if entries is not None:
+            return any(is_dir for name, is_dir, size, mtime in entries)
+
+        with os.scandir(self.data_path) as it:
+            for entry in it:
+                if entry.name != ZWP_METADATA_DIR and entry.is_dir():
+                    return True
 
         return False
 
     @property
     def parts(self):
+        """
+        Parts shared by all users, see :meth:`PartAcl.predicate`.
+        """
         return self._parts
 
     @property
     def columns(self):
+        self._load_metadata()
         return self._columns
 
     @cached_property
     def part_thumbnails(self):
+        if self._snapshot is not None:
+            return self._snapshot.part_thumbnails
+
         if self._part_thumbnails:
             return self._part_thumbnails
 
-        self._part_thumbnails = {}
+        from .thumbnails import thumbnail_index
 
-        for thumb_path in self._meta.thumbnail_paths:
-            if not os.path.exists(thumb_path):
-                continue
+        indexes = []
+        self._load_metadata()
 
+        for thumb_path in self._meta.thumbnail_paths:
             if os.path.commonprefix([self.ds.path, thumb_path]) != self.ds.path:
                 print("Ignoring thumbnail path '{}': left data source directory".format(
                     thumb_path
                 ))
                 continue
 
-            rel_path = os.path.relpath(thumb_path, self.ds.path)
+            index = thumbnail_index.get(thumb_path, self.ds.path)
 
-            for f in os.listdir(thumb_path):
-                parts = f.split('.')
+            if index:
+                indexes.append(index)
 
-                if parts[-1].lower() not in ['jpg', 'png']:
-                    continue
+        if len(indexes) == 1:
+            # Shared with other directories, it is not modified
+            self._part_thumbnails = indexes[0]
 
-                self._part_thumbnails['.'.join(parts[0:-1])] = os.path.join(
-                    rel_path, f
-                )
+        else:
+            self._part_thumbnails = {}
+
+            for index in indexes:
+                self._part_thumbnails.update(index)
 
         return self._part_thumbnails
 
@@ -291,76 +537,171 @@ class Directory(Item):
         if self._loaded:
             return
 
+        if self._snapshot is not None:
+            self._snapshot.load()
+            self._children = self._snapshot._children
+            self._parts = self._snapshot._parts
+            self._versions = self._snapshot._versions
+            self._stamp = self._snapshot._stamp
+            self._loaded = True
+            return
+
         self._children = []
-        abs_path = self.data_path
-        parts = {}
+        parts = []
 
-        for f in sorted(os.listdir(abs_path)):
-            item_abs_path = os.path.join(abs_path, f)
+        for f, is_dir, size, mtime in self._entries():
+            if is_dir:
+                self._children.append(Directory._get(self.ds, self.full_path, f))
 
-            if os.path.isdir(item_abs_path):
-                if f == ZWP_METADATA_DIR:
-                    continue
+            else:
+                p = self.make_part(f, size=size, mtime=mtime)
 
-                d = Directory.get(self.ds, self.full_path, f, user=self.user)
+                if p:
+                    parts.append(p)
 
-                if d.accessible:
-                    self._children.append(d)
+        self._set_parts(parts)
+        self._stamp = _new_stamp()
+        self._loaded = True
 
-            elif os.path.isfile(item_abs_path):
-                p = self.make_part(f.encode('utf8', 'replace').decode('utf-8'))
+    def make_part(self, name, size=None, mtime=None):
+        """
+        Return a new part, or ``None`` if the part type is filtered out.
+        """
+        p = Part(self, name, size=size, mtime=mtime)
 
-                if p and p.type in ZWP_VERSIONED_PARTS:
-                    if p.version_name in parts:
-                        if p.version > parts[p.version_name].version:
-                            self._parts.remove(parts[p.version_name])
-                            parts[p.version_name] = p
+        if ZWP_PART_FILTERS is not None and p.type not in ZWP_PART_FILTERS:
+            return
 
-                        else:
-                            continue
+        return p
 
-                    else:
-                        parts[p.version_name] = p
+    def part_versions(self, version_name):
+        """
+        Return all versions of versioned part ``version_name``, see
+        :attr:`Part.version_name`, sorted from the newest one.
+        """
+        if not self._loaded:
+            self.load()
 
-                if p:
-                    self._parts.append(p)
+        return list(self._versions.get(version_name, []))
 
-        self._loaded = True
+    def metadata_for(self, name):
+        self._load_metadata()
+        return self._parts_meta[name]
 
-    def make_part(self, name):
-        p = Part(self, name)
+    def _set_parts(self, parts):
+        """
+        Set parts from a list of all parts sorted by name. Only the newest
+        version of versioned parts is kept in :attr:`parts`, the order is
+        preserved.
+        """
+        self._versions = {}
 
-        if ZWP_PART_FILTERS and p.type not in ZWP_PART_FILTERS:
-            return
+        for p in parts:
+            if p.type in ZWP_VERSIONED_PARTS:
+                self._versions.setdefault(p.version_name, []).append(p)
 
-        if self.user and self.user.part_acl.can_access(self.ds, p):
-            p.accessible = True
+        for versions in self._versions.values():
+            # The sort is stable, of versions with the same number the first
+            # one by name wins
+            versions.sort(key=lambda p: p.version, reverse=True)
 
-        return p
+        self._parts = [
+            p for p in parts
+            if p.type not in ZWP_VERSIONED_PARTS or self._versions[p.version_name][0] is p
+        ]
 
-    def metadata_for(self, name):
-        return self._parts_meta[name]
+    def _entries(self):
+        """
+        Return a list of ``(name, is_dir, size, mtime)`` tuples of directory
+        entries sorted by name, from the catalog if possible. Size and mtime
+        are ``None`` for directories.
+        """
+        entries = self._catalog_entries()
+
+        if entries is not None:
+            return entries
+
+        ret = []
+
+        # DirEntry knows the entry type without calling stat() on most
+        # platforms and caches the result of stat(), so each file is stat'ed
+        # only once
+        with os.scandir(self.data_path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir():
+                        if entry.name == ZWP_METADATA_DIR:
+                            continue
+
+                        ret.append((entry.name, True, None, None))
+
+                    elif entry.is_file():
+                        st = entry.stat()
+                        ret.append((
+                            entry.name.encode('utf8', 'replace').decode('utf-8'),
+                            False,
+                            st.st_size,
+                            st.st_mtime
+                        ))
+
+                except OSError:
+                    continue
+
+        ret.sort(key=lambda x: x[0])
+        return ret
+
+    def _catalog_entries(self):
+        catalog = get_catalog()
+
+        if catalog is None:
+            return None
+
+        return catalog.entries(self.ds.name, self.full_path)
 
     def _load_acl(self):
         acl = Acl(self)
 
         if not acl.exists():
-            self.accessible = True
+            self._acl_users = None
             return
 
         elif not acl.parse():
-            self.accessible = False
+            self._acl_users = frozenset()
             return
 
-        self.accessible = acl.is_accessible(self.user)
+        self._acl_users = acl.allowed_users()
 
-    def _load_metadata(self):
+    def _load_label(self):
+        """
+        Read only labels from metadata, included files, columns and part
+        data are loaded on first access by :meth:`_load_metadata`.
+        """
         self._meta = Metadata(self)
 
+        if self._meta.exists():
+            self._meta.read_directory()
+            self._labels = self._meta.labels
+
+    def _load_metadata(self):
+        if self._meta_loaded:
+            return
+
+        self._meta_loaded = True
+
+        if self._snapshot is not None:
+            # Shared with the snapshot, and so with parts
+            self._snapshot._load_metadata()
+            self._meta = self._snapshot._meta
+            self._columns = self._snapshot._columns
+            self._parts_meta = self._snapshot._parts_meta
+            return
+
+        if self._meta is None:
+            self._meta = Metadata(self)
+
         if not self._meta.exists() or not self._meta.parse():
             return
 
-        self._label = self._meta.label
         self._columns = self._meta.columns
         self._parts_meta = self._meta.parts_data
 
@@ -446,6 +787,10 @@ class Directory(Item):
                 self._indexes[k] = v
 
 
+def _new_stamp():
+    return random.getrandbits(64)
+
+
 def index_fn(v, m):
     @property
     def method(self):
@@ -459,10 +804,24 @@ for i in ['tech_spec', 'parts_index']:
 
 
 class Part:
-    def __init__(self, d, name, accessible=False):
+    """
+    Parts are compact records, as directories can contain tens of thousands
+    of them. The name is parsed once on construction.
+
+    Parts are shared by all users, they belong to the directory snapshot.
+    """
+    __slots__ = (
+        '_dir', '_name', '_size', '_mtime',
+        'type', 'version', 'base_name', 'version_name', '_thumbnail_context',
+    )
+
+    def __init__(self, d, name, size=None, mtime=None):
         self._dir = d
         self._name = name
-        self.accessible = accessible
+        self._size = size
+        self._mtime = mtime
+        self._thumbnail_context = None
+        self._parse_name()
 
     def __str__(self):
         return 'Part {}/{}/{}'.format(self.ds.name, self.dir.full_path, self.name)
@@ -483,54 +842,14 @@ class Part:
     def name(self):
         return self._name
 
-    @cached_property
-    def base_name(self):
-        if self.type in ZWP_VERSIONED_PARTS and self.version > 0:
-            return '.'.join(self._name.split('.')[0:-2])
-
-        return '.'.join(self._name.split('.')[0:-1])
-
-    @cached_property
-    def version_name(self):
-        if self.type in ZWP_VERSIONED_PARTS:
-            return '.'.join(self._name.split('.')[0:-1])
-
-        return self.base_name
-
-    @cached_property
-    def type(self):
-        """
-        Get part type, which is its extension.
-        """
-        parts = self._name.split('.')
-
-        # .prt files are versioned, i.e. they end with a number
-        if parts[-1].isdigit() and len(parts) > 1:
-            self.version = int(parts[-1])
-            return parts[-2]
-
-        else:
-            self.version = 0
-            return parts[-1]
-
-    @cached_property
-    def version(self):
-        """
-        Get part version. The version is specified only for PRT files
-        as a number after the extension, e.g. some-part.prt.1, where 1
-        is the version.
-        """
-        self.type  # sets self.version
-        return self.version
-
-    @cached_property
+    @property
     def data_path(self):
         return os.path.join(
             self.dir.data_path,
             self.name,
         )
 
-    @cached_property
+    @property
     def hash(self):
         return hashlib.sha256(''.join(os.path.join(
             self.ds.name,
@@ -538,11 +857,21 @@ class Part:
             self.name
         )).encode('utf-8')).hexdigest()
 
-    @cached_property
+    @property
     def size(self):
-        return os.stat(self.data_path).st_size
+        if self._size is None:
+            self._stat()
 
-    @cached_property
+        return self._size
+
+    @property
+    def mtime(self):
+        if self._mtime is None:
+            self._stat()
+
+        return self._mtime
+
+    @property
     def thumbnail(self):
         try:
             return self._dir.part_thumbnails[self.base_name]
@@ -550,13 +879,17 @@ class Part:
         except KeyError:
             return None
 
-    @cached_property
+    @property
     def thumbnail_context(self):
-        if not self.thumbnail:
-            return {}
+        if self._thumbnail_context is None:
+            if not self.thumbnail:
+                self._thumbnail_context = {}
+
+            else:
+                from .thumbnails import get_thumbnail_backend
+                self._thumbnail_context = get_thumbnail_backend()(self)
 
-        from .thumbnails import get_thumbnail_backend
-        return get_thumbnail_backend()(self)
+        return self._thumbnail_context
 
     def get_column(self, n):
         try:
@@ -565,7 +898,7 @@ class Part:
         except KeyError:
             return None
 
-    @cached_property
+    @property
     def _meta(self):
         try:
             return self._dir.metadata_for(self.base_name)
@@ -573,17 +906,90 @@ class Part:
         except KeyError:
             return {}
 
+    def _parse_name(self):
+        """
+        Set part type, version, base name and version name.
+
+        Type is the extension. The version is specified only for versioned
+        parts as a number after the extension, e.g. some-part.prt.1, where 1
+        is the version.
+        """
+        parts = self._name.split('.')
+
+        if parts[-1].isdigit() and len(parts) > 1:
+            self.version = int(parts[-1])
+            self.type = parts[-2]
+
+        else:
+            self.version = 0
+            self.type = parts[-1]
+
+        if self.type in ZWP_VERSIONED_PARTS:
+            self.version_name = '.'.join(parts[0:-1])
+
+            if self.version > 0:
+                self.base_name = '.'.join(parts[0:-2])
+
+            else:
+                self.base_name = self.version_name
+
+        else:
+            self.base_name = '.'.join(parts[0:-1])
+            self.version_name = self.base_name
+
+    def _stat(self):
+        st = os.stat(self.data_path)
+        self._size = st.st_size
+        self._mtime = st.st_mtime
+
 
 class PartAcl:
-    def __init__(self):
+    """
+    Part types accessible to a user. Rules for a data source are read from
+    its users file when the data source is first accessed.
+    """
+    def __init__(self, username=None):
+        self.username = username
         self.rules = {}
 
     def add(self, ds, allowed):
-        self.rules[ds.name] = allowed
+        self.rules[ds.name] = frozenset(allowed)
 
-    def can_access(self, ds, part):
-        allowed = self.rules[ds.name]
-        return part.type in allowed or '@all' in allowed
+    def allowed(self, ds):
+        try:
+            return self.rules[ds.name]
+
+        except KeyError:
+            self.add(ds, Users(ds).get_parts(self.username))
+            return self.rules[ds.name]
+
+    def predicate(self, ds):
+        """
+        Return a function that takes a part type and returns ``True`` if it is
+        accessible in data source ``ds``.
+        """
+        allowed = self.allowed(ds)
+
+        if '@all' in allowed:
+            return _allow_all
+
+        return allowed.__contains__
+
+    def fingerprint(self, ds):
+        """
+        Return a string describing part types accessible in data source
+        ``ds``, which is the same for users with equal rights.
+        """
+        allowed = self.allowed(ds)
+
+        if '@all' in allowed:
+            return '@all'
+
+        return ','.join(sorted(allowed))
+
+
+def _allow_all(part_type):
+    return True
 
 
 class PartModelManager(models.Manager):
@@ -600,6 +1006,11 @@ class PartModel(models.Model):
     hash = models.CharField(_('hash'), max_length=64, unique=True)
     objects = PartModelManager()
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['ds_name', 'dir_path', 'name']),
+        ]
+
     @property
     def part(self):
         if hasattr(self, '_part'):
@@ -622,16 +1033,40 @@ class PartModel(models.Model):
     def part(self, v):
         self._part = v
 
+    @staticmethod
+    def resolve(part_models):
+        """
+        Resolve :attr:`part` of all ``part_models`` at once. Each directory
+        is loaded only once and parts are looked up by name. Returns
+        ``part_models``.
+        """
+        groups = {}
+
+        for pm in part_models:
+            groups.setdefault((pm.ds_name, pm.dir_path), []).append(pm)
+
+        for (ds_name, dir_path), pms in groups.items():
+            d = Directory.from_path(ds_name, dir_path, load=True)
+            parts = {p.name: p for p in d.parts} if d else {}
+
+            for pm in pms:
+                pm._part = parts.get(pm.name)
+
+        return part_models
+
     def save(self, *args, **kwargs):
         if not self.pk:
-            self.hash = hashlib.sha256(''.join(os.path.join(
-                self.ds_name,
-                self.dir_path,
-                self.name
-            )).encode('utf-8')).hexdigest()
+            self.hash = self.make_hash()
 
         super(PartModel, self).save(*args, **kwargs)
 
+    def make_hash(self):
+        return hashlib.sha256(os.path.join(
+            self.ds_name,
+            self.dir_path,
+            self.name
+        ).encode('utf-8')).hexdigest()
+
 
 class DownloadBatch(models.Model):
     OPEN = 0
@@ -652,8 +1087,10 @@ class DownloadBatch(models.Model):
     key = models.CharField(_('unique key'), max_length=40, unique=True)
     created_at = models.DateTimeField(_('created at'), auto_now_add=True)
     updated_at = models.DateTimeField(_('updated at'), null=True)
+    started_at = models.DateTimeField(_('started at'), null=True)
     state = models.IntegerField(_('state'), default=OPEN)
     zip_file = models.CharField(_('zip file'), max_length=255, null=True)
+    content_key = models.CharField(_('content key'), max_length=64, null=True, db_index=True)
 
     def __str__(self):
         return 'DownloadBatch #{}'.format(self.pk)
@@ -674,10 +1111,39 @@ class DownloadBatch(models.Model):
 
     @property
     def size(self):
-        return sum([
-            dl.part_model.part.size
-            for dl in self.partdownload_set.select_related('part_model').all()
-        ])
+        ret = 0
+        unknown = []
+
+        for dl in self.partdownload_set.select_related('part_model').all():
+            if dl.size is None:
+                unknown.append(dl.part_model)
+
+            else:
+                ret += dl.size
+
+        for pm in PartModel.resolve(unknown):
+            if pm.part is not None:
+                ret += pm.part.size
+
+        return ret
+
+    def stored_size(self):
+        """
+        Return the sum of part sizes stored when the parts were marked,
+        without resolving any parts. Sizes missing in older rows are not
+        counted.
+        """
+        return self.partdownload_set.aggregate(size=models.Sum('size'))['size'] or 0
+
+    def part_downloads(self):
+        """
+        Return a list of part downloads ordered by part name, with parts
+        resolved in bulk by :meth:`PartModel.resolve`.
+        """
+        dls = list(self.partdownload_set.select_related('part_model').all() \
+            .order_by('part_model__name'))
+        PartModel.resolve([dl.part_model for dl in dls])
+        return dls
 
     @cached_property
     def count(self):
@@ -685,6 +1151,9 @@ class DownloadBatch(models.Model):
 
     @cached_property
     def zip_url(self):
+        if ZWP_DOWNLOAD_STREAM:
+            return reverse('zwp_download_zip', kwargs={'key': self.key})
+
         return os.path.join(ZWP_DOWNLOAD_URL, self.key, self.zip_file + '.zip')
 
     @cached_property
@@ -700,8 +1169,81 @@ class DownloadBatch(models.Model):
         except OSError:
             return None
 
+    def zip_files(self):
+        """
+        Return a list of ``(path, arcname, ds)`` tuples of parts to be put
+        into the ZIP file. Parts that no longer exist are skipped.
+        """
+        ret = []
+
+        for dl in self.part_downloads():
+            part = dl.part_model.part
+
+            if part is None:
+                continue
+
+            ret.append((
+                part.data_path,
+                '{}/{}'.format(self.zip_file, part.name),
+                part.dir.ds
+            ))
+
+        return ret
+
+    def content_hash(self, files):
+        """
+        Return a hash of paths, mtimes, sizes and compression of ``files``, a list
+        of ``(path, arcname, ds)`` tuples from :meth:`zip_files`. Batches with
+        the same hash have identical ZIP files.
+        """
+        h = hashlib.sha256()
+
+        for path, arcname, ds in sorted(files, key=lambda f: f[0]):
+            st = os.stat(path)
+            h.update('{}\0{}\0{}\0{}\0{}\n'.format(
+                path,
+                st.st_mtime_ns,
+                st.st_size,
+                ds.compression,
+                ds.compresslevel
+            ).encode('utf-8', 'surrogateescape'))
+
+        return h.hexdigest()
+
     def make_zip(self):
         from .utils import find_interpreter
+        from .zipbuild import zip_paths, reuse_zip
+
+        if ZWP_DOWNLOAD_STREAM:
+            # The ZIP file is generated by the zwp_download_zip view while it
+            # is being downloaded
+            self.zip_file = zip_paths(self)[0]
+            self.state = self.DONE
+            self.updated_at = timezone.now()
+            self.save()
+            return True
+
+        # Progress of an earlier failed attempt
+        clear_zip_progress(self.pk)
+
+        try:
+            self.content_key = self.content_hash(self.zip_files())
+
+        except OSError:
+            self.content_key = None
+
+        if reuse_zip(self):
+            return True
+
+        self.save()
+
+        if ZWP_DOWNLOAD_QUEUE:
+            # The ZIP file is created by the zipworker management command
+            self.zip_file = zip_paths(self)[0]
+            self.state = self.PREPARING
+            self.started_at = None
+            self.save()
+            return True
 
         ret = subprocess.call([
             find_interpreter(),
@@ -725,6 +1267,8 @@ class PartDownload(models.Model):
     download_batch = models.ForeignKey(DownloadBatch, on_delete=models.CASCADE)
     part_model = models.ForeignKey(PartModel, on_delete=models.CASCADE)
     added_at = models.DateTimeField(_('added at'), auto_now_add=True)
+    size = models.BigIntegerField(_('size'), null=True)
+    mtime = models.FloatField(_('modification time'), null=True)
 
     class Meta:
         unique_together = (('download_batch', 'part_model'),)
@@ -25,5 +25,65 @@ ZWP_DOWNLOAD_URL = getattr(
     os.path.join(settings.MEDIA_URL, 'zwp/downloads')
 )
 
+# Part type lists are converted to sets for fast membership tests
 ZWP_PART_FILTERS = getattr(settings, 'ZWP_PART_FILTERS', None)
-ZWP_VERSIONED_PARTS = getattr(settings, 'ZWP_VERSIONED_PARTS', ['asm', 'drw', 'prt'])
+ZWP_PART_FILTERS = frozenset(ZWP_PART_FILTERS) if ZWP_PART_FILTERS else None
+ZWP_VERSIONED_PARTS = frozenset(getattr(settings, 'ZWP_VERSIONED_PARTS', ['asm', 'drw', 'prt']))
+
+# Path to the SQLite database with the data source catalog, see the scancatalog
+# management command. The catalog is not used when set to None.
+ZWP_CATALOG = getattr(settings, 'ZWP_CATALOG', None)
+
+# Timeouts of cached directory instances and rendered directory contents.
+# They can be raised considerably when caches are invalidated by the watchdirs
+# management command. Rendered contents are shared by users with equal rights,
+# selection of parts for download is filled in for each request.
+ZWP_DIR_CACHE_TIMEOUT = getattr(settings, 'ZWP_DIR_CACHE_TIMEOUT', 60)
+ZWP_DIR_CONTENT_CACHE_TIMEOUT = getattr(settings, 'ZWP_DIR_CONTENT_CACHE_TIMEOUT', 60)
+
+# Maximum number of parsed metadata, ACL and users files kept in memory
+# by each process
+ZWP_CONFIG_CACHE_SIZE = getattr(settings, 'ZWP_CONFIG_CACHE_SIZE', 256)
+
+# Maximum number of thumbnail directory listings kept in memory by each process
+ZWP_THUMBNAIL_INDEX_SIZE = getattr(settings, 'ZWP_THUMBNAIL_INDEX_SIZE', 256)
+
+# Name of the compiled metadata file created by the compilemetadata management
+# command in metadata directories, e.g. 'metadata.json'. Compiled files are not
+# used when set to None, nor for directories in the catalog, see ZWP_CATALOG.
+ZWP_METADATA_COMPILED_FILE = getattr(settings, 'ZWP_METADATA_COMPILED_FILE', None)
+
+# Stream ZIP files to clients while they are being created instead of building
+# them in ZWP_DOWNLOAD_ROOT by the makezip management command
+ZWP_DOWNLOAD_STREAM = getattr(settings, 'ZWP_DOWNLOAD_STREAM', False)
+
+# Create ZIP files by the zipworker management command instead of starting
+# the makezip command for each download batch. ZWP_DOWNLOAD_WORKERS is the default
+# number of ZIP files created at the same time by each worker.
+ZWP_DOWNLOAD_QUEUE = getattr(settings, 'ZWP_DOWNLOAD_QUEUE', False)
+ZWP_DOWNLOAD_WORKERS = getattr(settings, 'ZWP_DOWNLOAD_WORKERS', 2)
+
+# Seconds after which a batch claimed by a zipworker that stopped renewing
+# the claim, e.g. because it crashed, is queued again
+ZWP_DOWNLOAD_CLAIM_TIMEOUT = getattr(settings, 'ZWP_DOWNLOAD_CLAIM_TIMEOUT', 300)
+
+# Compression of ZIP files created for download, one of 'stored', 'deflated',
+# 'bzip2' or 'lzma', and the compression level. Both can be overridden
+# by options 'compression' and 'compresslevel' of each data source. Compressed
+# entries are created by up to ZWP_DOWNLOAD_COMPRESS_THREADS threads.
+# Streamed ZIP files are not compressed.
+ZWP_DOWNLOAD_COMPRESSION = getattr(settings, 'ZWP_DOWNLOAD_COMPRESSION', 'stored')
+ZWP_DOWNLOAD_COMPRESSLEVEL = getattr(settings, 'ZWP_DOWNLOAD_COMPRESSLEVEL', None)
+ZWP_DOWNLOAD_COMPRESS_THREADS = getattr(
+    settings,
+    'ZWP_DOWNLOAD_COMPRESS_THREADS',
+    os.cpu_count() or 1
+)
+
+# Seconds for which requests for download status wait for a change of the ZIP
+# file progress, long polling is disabled when set to 0. Waiting clients receive
+# progress at most every ZWP_DOWNLOAD_WAIT_INTERVAL seconds, changes of state
+# are sent within a second. Each waiting request occupies a worker of the
+# application server, so the timeout is kept short.
+ZWP_DOWNLOAD_WAIT_TIMEOUT = getattr(settings, 'ZWP_DOWNLOAD_WAIT_TIMEOUT', 10)
+ZWP_DOWNLOAD_WAIT_INTERVAL = getattr(settings, 'ZWP_DOWNLOAD_WAIT_INTERVAL', 5)
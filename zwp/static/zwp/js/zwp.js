@@ -189,9 +189,11 @@
 	zwp.waitForDownload = function (url, preparing, done, error, progress) {
 		var timeout;
 
-		function update () {
+		function update (last) {
 			$.ajax({
 				url: url,
+				// With the last response, the server waits until there is a change
+				data: last && last.seq !== null ? {since: last.seq, state: last.state} : {},
 				dataType: 'json',
 				error: function () {
 					$(preparing).addClass('hidden');
@@ -202,7 +204,7 @@
 						case 0: // open
 						case 1: // preparing
 							$(preparing).removeClass('hidden');
-							$(progress).html(filesize(response.real_size));
+							$(progress).html(filesize(response.real_size || 0));
 							break;
 
 						case 2: // done
@@ -218,7 +220,12 @@
 							return;
 					}
 
-					timeout = setTimeout(update, 1000);
+					if (response.seq === null || response.seq === undefined) {
+						timeout = setTimeout(update, 1000);
+
+					} else {
+						update(response);
+					}
 				}
 			});
 		}
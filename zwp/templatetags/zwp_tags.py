@@ -1,10 +1,11 @@
 from django import template
 from django.http import Http404
+from django.template.defaulttags import CsrfTokenNode
+from django.template.loader import render_to_string
 from django.utils.safestring import mark_safe
-from zwp.utils import format_dir, static_url
+from zwp.utils import tree_json, static_url
 from zwp.models import Directory
-import os
-import json
+import re
 from zwp.settings import *
 
 
@@ -17,19 +18,12 @@ def directory_tree(context):
         parent = None
 
     else:
-        parent_path = os.path.dirname(context['zwp_dir'].path)
-        parent_name = os.path.basename(context['zwp_dir'].path)
-
-        if parent_name:
-            root = False
-
-        else:
-            parent_name = os.path.basename(context['zwp_dir'].ds.path)
-            root = True
-
-        print("parent_path={}, parent_name={}".format(parent_path, parent_name))
-
-        parent = Directory(context['zwp_dir'].ds, parent_path, parent_name, root=root, user=context['request'].user)
+        # The cached snapshot, its content stamp is a part of the page ETag
+        parent = Directory.from_path(
+            context['zwp_dir'].ds.name,
+            context['zwp_dir'].path,
+            user=context['request'].user
+        )
 
     try:
         context.update({
@@ -46,16 +40,73 @@ def directory_tree(context):
 
 @register.simple_tag(takes_context=True)
 def zwp_json_tree(context):
-    ret = []
     d = context['zwp_dir']
     path = d.full_path.split('/')
 
-    root = Directory(d.ds, '', os.path.basename(d.ds.path), root=True, user=context['request'].user)
+    return mark_safe(tree_json(d.ds, '', context['request'].user, path))
+
+
+USER_STATE_RE = re.compile(r'<!--zwp:([a-z]+)(?::(\d+))?-->')
+
+
+class UserStateNode(template.Node):
+    def __init__(self, nodelist, formset):
+        self.nodelist = nodelist
+        self.formset = formset
+
+    def render(self, context):
+        formset = self.formset.resolve(context)
+        csrf_token = CsrfTokenNode().render(context)
+        selection = None
+
+        def replace(m):
+            nonlocal selection
+            name, index = m.groups()
+
+            if name == 'csrf':
+                return csrf_token
+
+            elif name == 'selection':
+                if selection is None:
+                    selection = render_to_string(
+                        'zwp/dir_selection.html',
+                        {'formset': formset},
+                        context.get('request')
+                    )
+
+                return selection
+
+            elif name == 'download':
+                return str(formset.forms[int(index)]['download'])
+
+            return m.group(0)
+
+        return mark_safe(USER_STATE_RE.sub(replace, self.nodelist.render(context)))
+
+
+@register.tag
+def zwp_user_state(parser, token):
+    """
+    Fill in state of the current user into the enclosed block, which can then
+    be cached for all users with equal rights::
+
+        {% zwp_user_state formset %}...{% endzwp_user_state %}
+
+    The block contains placeholders ``<!--zwp:csrf-->`` for the CSRF token,
+    ``<!--zwp:selection-->`` for the count of selected parts and
+    ``<!--zwp:download:N-->`` for the download checkbox of the N-th form.
+    """
+    bits = token.split_contents()
+
+    if len(bits) != 2:
+        raise template.TemplateSyntaxError(
+            "'{}' tag requires exactly one argument".format(bits[0])
+        )
 
-    for child in root.children:
-        ret.append(format_dir(child, path))
+    nodelist = parser.parse(('endzwp_user_state',))
+    parser.delete_first_token()
 
-    return mark_safe(json.dumps(ret))
+    return UserStateNode(nodelist, parser.compile_filter(bits[1]))
 
 
 @register.filter
@@ -1,3 +1,627 @@
-from django.test import TestCase
+from django.contrib.auth.models import AnonymousUser, User
+from django.core.cache import cache
+from django.test import RequestFactory, TestCase
+from django.urls import reverse
+from django.utils import timezone, translation
+import json
+import os
+import pickle
+import shutil
+import tempfile
+import threading
+import time
+import tracemalloc
+import zipfile
+from unittest import mock
+from .cache import dir_instance_key, get_zip_progress, set_zip_progress, wait_zip_progress, clear_zip_progress
+from .catalog import Catalog
+from .forms import PartDownloadFormSet
+from .management.commands.benchparts import part_names, make_parts
+from .metadata import ConfigCache, Metadata
+from .models import DataSource, Directory, DownloadBatch, PartAcl
+from .settings import ZWP_METADATA_DIR, ZWP_METADATA_FILE, ZWP_ACL_FILE
+from .thumbnails import ThumbnailIndex
+from .utils import tree_json
+from .zipbuild import COMPRESSION, reuse_zip, write_zip
 
-# Create your tests here.
+
+class DirectoryCacheRecordTest(TestCase):
+    DIRS = 50
+    PARTS = 500
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+        for i in range(self.DIRS):
+            os.mkdir(os.path.join(self.path, 'dir-{:03d}'.format(i)))
+
+        for i in range(self.PARTS):
+            for v in (1, 2):
+                with open(os.path.join(self.path, 'part-{:04d}.prt.{}'.format(i, v)), 'w') as f:
+                    f.write('x' * v)
+
+        override = self.settings(ZWP_DATA_SOURCES=[{'name': 'test', 'path': self.path}])
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_roundtrip(self):
+        d = Directory._from_path('test', '', load=True)
+        restored = Directory.from_record(d.to_record())
+
+        self.assertTrue(restored.loaded)
+        self.assertEqual(restored.full_path, d.full_path)
+        self.assertEqual(
+            [child.name for child in restored.children],
+            [child.name for child in d.children]
+        )
+        self.assertEqual(
+            [(p.name, p.size, p.mtime) for p in restored.parts],
+            [(p.name, p.size, p.mtime) for p in d.parts]
+        )
+
+    def test_part_versions(self):
+        d = Directory._from_path('test', '', load=True)
+        restored = Directory.from_record(d.to_record())
+
+        for directory in (d, restored):
+            self.assertEqual(len(directory.parts), self.PARTS)
+            self.assertEqual(
+                [p.name for p in directory.part_versions('part-0000.prt')],
+                ['part-0000.prt.2', 'part-0000.prt.1']
+            )
+
+    def test_labels(self):
+        meta_dir = os.path.join(self.path, 'dir-000', ZWP_METADATA_DIR)
+        os.mkdir(meta_dir)
+
+        with open(os.path.join(meta_dir, ZWP_METADATA_FILE), 'w') as f:
+            f.write('[Directory]\nLabel/en="English"\nLabel/cs="Czech"\n')
+
+        with translation.override('en'):
+            d = Directory._from_path('test', '', load=True)
+            restored = Directory.from_record(d.to_record())
+
+        child = restored.all_children()[0]
+
+        with translation.override('cs'):
+            self.assertEqual(child.label, 'Czech')
+
+        with translation.override('de'):
+            self.assertEqual(child.label, 'dir-000')
+
+    def test_record_version(self):
+        record = Directory._from_path('test', '').to_record()
+        self.assertIsNone(Directory.from_record((-1,) + record[1:]))
+
+    def test_record_size(self):
+        d = Directory._from_path('test', '', load=True)
+        size = len(pickle.dumps(d.to_record(), pickle.HIGHEST_PROTOCOL))
+
+        # Bound the size of the cache entry per child directory and part,
+        # each part has two versions
+        self.assertLess(size, 256 + self.DIRS * 32 + self.PARTS * 2 * 40)
+
+
+class CatalogTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.ds = DataSource({'name': 'test', 'path': os.path.join(self.path, 'data')})
+
+        os.makedirs(os.path.join(self.ds.path, 'sub', 'deep'))
+        self.write('a.prt.1', 'abc')
+        self.write('sub/b.asm.1', 'x')
+
+        self.catalog = Catalog(os.path.join(self.path, 'catalog.sqlite3'))
+        self.addCleanup(lambda: self.catalog.conn.close())
+
+    def write(self, name, data):
+        with open(os.path.join(self.ds.path, name), 'w') as f:
+            f.write(data)
+
+    def test_scan(self):
+        stats = self.catalog.scan(self.ds)
+
+        self.assertEqual(stats['scanned'], 3)
+        self.assertEqual(stats['updated'], 3)
+        self.assertEqual(
+            [(name, is_dir, size) for name, is_dir, size, mtime in self.catalog.entries('test', '')],
+            [('a.prt.1', False, 3), ('sub', True, None)]
+        )
+        self.assertEqual(
+            [name for name, is_dir, size, mtime in self.catalog.entries('test', 'sub')],
+            ['b.asm.1', 'deep']
+        )
+        self.assertIsNone(self.catalog.entries('test', 'missing'))
+
+    def test_scan_incremental(self):
+        self.catalog.scan(self.ds)
+        st = os.stat(self.ds.path)
+
+        # Modified in place, the directory mtime is unchanged
+        self.write('a.prt.1', 'abcdefg')
+        os.utime(self.ds.path, ns=(st.st_atime_ns, st.st_mtime_ns))
+
+        stats = self.catalog.scan(self.ds)
+
+        self.assertEqual(stats['updated'], 0)
+        self.assertEqual(stats['refreshed'], 1)
+        self.assertEqual(self.catalog.entries('test', '')[0][2], 7)
+
+        shutil.rmtree(os.path.join(self.ds.path, 'sub'))
+        stats = self.catalog.scan(self.ds)
+
+        self.assertEqual(stats['updated'], 1)
+        self.assertEqual(stats['removed'], 2)
+        self.assertIsNone(self.catalog.entries('test', 'sub/deep'))
+
+    def test_scan_symlink_cycle(self):
+        os.symlink(self.ds.path, os.path.join(self.ds.path, 'sub', 'deep', 'loop'))
+
+        stats = self.catalog.scan(self.ds)
+
+        self.assertEqual(stats['scanned'], 3)
+        self.assertIsNone(self.catalog.entries('test', 'sub/deep/loop'))
+
+    def test_scan_undecodable_name(self):
+        os.makedirs(os.path.join(self.ds.path, 'd\udce9j\udce0', 'deep'))
+
+        stats = self.catalog.scan(self.ds)
+
+        self.assertEqual(stats['scanned'], 3)
+        self.assertEqual(
+            [name for name, is_dir, size, mtime in self.catalog.entries('test', '')],
+            ['a.prt.1', 'sub']
+        )
+
+        self.catalog.update(self.ds, 'd\udce9j\udce0')
+        self.assertIsNotNone(self.catalog.entries('test', ''))
+
+    def test_metadata(self):
+        os.mkdir(os.path.join(self.ds.path, 'sub', ZWP_METADATA_DIR))
+        self.write(
+            os.path.join('sub', ZWP_METADATA_DIR, ZWP_METADATA_FILE),
+            '[Directory]\nLabel/en="Sub"\n[Parameters]\nA=1\n'
+        )
+        self.catalog.scan(self.ds)
+
+        queries = []
+        self.catalog.conn.set_trace_callback(queries.append)
+
+        with mock.patch('zwp.catalog.get_catalog', return_value=self.catalog), \
+             translation.override('en'):
+            d = Directory(self.ds, '', 'sub')
+            self.assertEqual(d.label, 'Sub')
+
+            # Metadata and ACL handles of the directory, only the Directory
+            # section of the metadata is loaded
+            self.assertEqual(len(queries), 2)
+
+            meta = Metadata(d)
+            self.assertTrue(meta.exists())
+            meta.read()
+
+            self.assertEqual(len(queries), 4)
+            self.assertTrue(meta.cfg.has_section('Parameters'))
+
+    def test_update(self):
+        self.catalog.scan(self.ds)
+        self.write('sub/c.drw.1', 'xy')
+        self.catalog.update(self.ds, 'sub')
+
+        self.assertEqual(
+            [name for name, is_dir, size, mtime in self.catalog.entries('test', 'sub')],
+            ['b.asm.1', 'c.drw.1', 'deep']
+        )
+
+        shutil.rmtree(os.path.join(self.ds.path, 'sub'))
+        self.catalog.update(self.ds, 'sub')
+
+        self.assertIsNone(self.catalog.entries('test', 'sub'))
+        self.assertIsNone(self.catalog.entries('test', 'sub/deep'))
+        self.assertIsNotNone(self.catalog.entries('test', ''))
+
+
+class MetadataCompileTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        os.mkdir(os.path.join(self.path, ZWP_METADATA_DIR))
+
+        override = self.settings(ZWP_DATA_SOURCES=[{'name': 'test', 'path': self.path}])
+        override.enable()
+        self.addCleanup(override.disable)
+
+    def test_label_only(self):
+        with open(os.path.join(self.path, ZWP_METADATA_DIR, ZWP_METADATA_FILE), 'w') as f:
+            f.write('[Directory]\nLabel/en="Label"\n')
+
+        d = Directory._from_path('test', '')
+        data = Metadata(d, use_compiled=False).compile()
+
+        self.assertFalse(data['has_data'])
+        self.assertEqual(data['labels'], {'en': 'Label'})
+        self.assertEqual(data['columns'], [])
+
+
+class PartMemoryTest(TestCase):
+    PARTS = 6000
+
+    def test_part_size(self):
+        names = part_names(self.PARTS)
+
+        tracemalloc.start()
+        parts = make_parts(names)
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        # Parts with a __dict__ and cached properties took about 690 B each,
+        # see the benchparts management command
+        self.assertEqual(len(parts), self.PARTS)
+        self.assertLess(size / self.PARTS, 400)
+
+
+class ZipProgressWaitTest(TestCase):
+    def setUp(self):
+        self.batch = DownloadBatch.objects.create(state=DownloadBatch.PREPARING, zip_file='parts')
+        self.addCleanup(clear_zip_progress, self.batch.pk)
+        self.publish(1, DownloadBatch.PREPARING)
+
+    def publish(self, seq, state):
+        set_zip_progress(self.batch.pk, {'seq': seq, 'state': state, 'zip_size': seq})
+
+    def wait(self, timeout, interval=0):
+        start = time.monotonic()
+        progress = wait_zip_progress(self.batch.pk, 1, DownloadBatch.PREPARING, timeout, interval)
+        return progress, time.monotonic() - start
+
+    def test_timeout(self):
+        progress, elapsed = self.wait(0.3)
+
+        self.assertEqual(progress['seq'], 1)
+        self.assertGreaterEqual(elapsed, 0.3)
+        self.assertLess(elapsed, 1)
+
+    def test_change(self):
+        timer = threading.Timer(0.1, self.publish, (2, DownloadBatch.PREPARING))
+        timer.start()
+        self.addCleanup(timer.cancel)
+
+        progress, elapsed = self.wait(5)
+
+        self.assertEqual(progress['seq'], 2)
+        self.assertLess(elapsed, 1)
+
+    def test_state_change(self):
+        self.publish(2, DownloadBatch.DONE)
+
+        progress, elapsed = self.wait(5, interval=5)
+
+        self.assertEqual(progress['state'], DownloadBatch.DONE)
+        self.assertLess(elapsed, 0.1)
+
+    def test_cleared(self):
+        clear_zip_progress(self.batch.pk)
+
+        self.assertIsNone(get_zip_progress(self.batch.pk))
+        self.assertIsNone(self.wait(5)[0])
+
+    def test_view_timeout(self):
+        with mock.patch('zwp.views.ZWP_DOWNLOAD_WAIT_TIMEOUT', 0.3):
+            start = time.monotonic()
+            response = self.client.get(
+                reverse('zwp_download', kwargs={'key': self.batch.key}),
+                {'since': 1, 'state': DownloadBatch.PREPARING},
+                HTTP_X_REQUESTED_WITH='XMLHttpRequest'
+            )
+
+        self.assertGreaterEqual(time.monotonic() - start, 0.3)
+        self.assertEqual(response.json()['seq'], 1)
+        self.assertEqual(response.json()['state'], DownloadBatch.PREPARING)
+
+
+class ConditionalRequestTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        os.makedirs(os.path.join(self.path, 'sub'))
+
+        with open(os.path.join(self.path, 'sub', 'part.prt.1'), 'w') as f:
+            f.write('x')
+
+        override = self.settings(ZWP_DATA_SOURCES=[{'name': 'test', 'path': self.path}])
+        override.enable()
+        self.addCleanup(override.disable)
+
+        self.url = reverse('zwp_dir', kwargs={'ds': 'test', 'path': 'sub'})
+        cache.clear()
+
+    def test_not_modified(self):
+        self.assertNotIn('ETag', self.client.get(self.url))
+        etag = self.client.get(self.url)['ETag']
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+        self.assertNotIn('Last-Modified', response)
+
+    def test_ancestor_evicted(self):
+        self.client.get(self.url)
+        etag = self.client.get(self.url)['ETag']
+
+        # Snapshot of the root directory, shown in the directory tree
+        cache.delete(dir_instance_key('test', ''))
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('ETag', response)
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class FileCacheTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.thumbs = os.path.join(self.path, 'thumbs')
+        os.mkdir(self.thumbs)
+
+        for name in ('a.png', 'b.JPG', 'c.txt'):
+            open(os.path.join(self.thumbs, name), 'w').close()
+
+    def test_thumbnail_index(self):
+        index = ThumbnailIndex(2)
+
+        self.assertIsNone(index.get(os.path.join(self.path, 'missing'), self.path))
+        self.assertEqual(index.get(self.thumbs, self.path), {
+            'a': os.path.join('thumbs', 'a.png'),
+            'b': os.path.join('thumbs', 'b.JPG'),
+        })
+        self.assertIs(index.get(self.thumbs, self.path), index.get(self.thumbs, self.path))
+        self.assertEqual(index.stats()['hits'], 2)
+
+        open(os.path.join(self.thumbs, 'd.png'), 'w').close()
+        os.utime(self.thumbs, ns=(0, 0))
+
+        self.assertIn('d', index.get(self.thumbs, self.path))
+
+    def test_config_cache(self):
+        path = os.path.join(self.path, 'test.ini')
+
+        with open(path, 'w') as f:
+            f.write('[Directory]\nlabel = one\n')
+
+        configs = ConfigCache(1)
+        cfg = configs.get(path)
+
+        self.assertIs(configs.get(path), cfg)
+        self.assertIsNot(configs.get(path, interpolation=False), cfg)
+        self.assertEqual(configs.stats()['entries'], 1)
+
+        with open(path, 'w') as f:
+            f.write('[Directory]\nlabel = two\n')
+
+        os.utime(path, ns=(0, 0))
+
+        self.assertEqual(configs.get(path)['Directory']['label'], 'two')
+
+
+class DirectoryTreeTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        meta = os.path.join(self.path, 'a', 'secret', ZWP_METADATA_DIR)
+        os.makedirs(meta)
+
+        with open(os.path.join(meta, ZWP_ACL_FILE), 'w') as f:
+            f.write('[allow]\nusers = alice\n')
+
+        override = self.settings(ZWP_DATA_SOURCES=[{'name': 'test', 'path': self.path}])
+        override.enable()
+        self.addCleanup(override.disable)
+        cache.clear()
+
+        self.ds = DataSource.from_name('test')
+        self.alice = User(username='alice')
+
+    def root_node(self, user):
+        return json.loads(tree_json(self.ds, '', user))[0]
+
+    def test_restricted_grandchild(self):
+        self.assertIs(self.root_node(None)['children'], True)
+
+    def test_restricted_grandchild_loaded(self):
+        # Opened by alice, the child is cached with loaded children
+        self.assertEqual(len(Directory.from_path('test', 'a', user=self.alice, load=True).children), 1)
+
+        self.assertIs(self.root_node(None)['children'], True)
+        self.assertIs(self.root_node(self.alice)['children'], True)
+        self.assertEqual(json.loads(tree_json(self.ds, 'a', None)), [])
+        self.assertEqual(len(json.loads(tree_json(self.ds, 'a', self.alice))), 1)
+
+
+class WriteZipTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.contents = {}
+
+        for i in range(8):
+            name = 'part-{}.prt.1'.format(i)
+            self.contents[name] = ('part {}\n'.format(i) * 1000 * (i + 1)).encode()
+
+            with open(os.path.join(self.path, name), 'wb') as f:
+                f.write(self.contents[name])
+
+    def test_mixed_compression(self):
+        # Stored entries are written by ZipFile.write(), compressed ones by
+        # _write_compressed(), which relies on ZipFile internals
+        sources = [
+            DataSource({'name': compression, 'path': self.path, 'compression': compression})
+            for compression in ('stored', 'deflated', 'stored', 'bzip2', 'stored', 'lzma')
+        ]
+        files = [
+            (os.path.join(self.path, name), 'parts/' + name, sources[i % len(sources)])
+            for i, name in enumerate(sorted(self.contents))
+        ]
+
+        zip_path = os.path.join(self.path, 'parts.zip')
+        write_zip(zip_path, files, threads=2)
+
+        with zipfile.ZipFile(zip_path) as z:
+            self.assertIsNone(z.testzip())
+            self.assertEqual(
+                [info.filename for info in z.infolist()],
+                [arcname for path, arcname, ds in files]
+            )
+            self.assertEqual(
+                {info.compress_type for info in z.infolist()},
+                set(COMPRESSION.values())
+            )
+
+            for name, data in self.contents.items():
+                self.assertEqual(z.read('parts/' + name), data)
+
+
+
+class ReuseZipTest(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.root = os.path.join(self.path, 'downloads')
+
+        patcher = mock.patch('zwp.zipbuild.ZWP_DOWNLOAD_ROOT', self.root)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.part = os.path.join(self.path, 'part.prt.1')
+
+        with open(self.part, 'w') as f:
+            f.write('part')
+
+        self.files = [(self.part, 'parts/part.prt.1', DataSource({'name': 'test', 'path': self.path}))]
+
+    def finished_batch(self, state=DownloadBatch.DONE):
+        """
+        Return a batch with a ZIP file of the current files.
+        """
+        batch = self.new_batch()
+        batch.state = state
+        batch.zip_file = 'parts-{}'.format(batch.pk)
+        batch.updated_at = timezone.now()
+        batch.save()
+
+        os.makedirs(os.path.join(self.root, batch.key))
+        open(self.zip_path(batch, batch.zip_file), 'w').close()
+        return batch
+
+    def new_batch(self):
+        batch = DownloadBatch.objects.create(state=DownloadBatch.OPEN)
+        batch.content_key = batch.content_hash(self.files)
+        return batch
+
+    def zip_path(self, batch, zip_file):
+        return os.path.join(self.root, batch.key, zip_file + '.zip')
+
+    def test_identical(self):
+        other = self.finished_batch()
+        batch = self.new_batch()
+
+        self.assertTrue(reuse_zip(batch))
+
+        batch.refresh_from_db()
+        self.assertEqual(batch.state, DownloadBatch.DONE)
+        self.assertEqual(batch.zip_file, other.zip_file)
+        self.assertTrue(os.path.samefile(
+            self.zip_path(batch, batch.zip_file),
+            self.zip_path(other, other.zip_file)
+        ))
+
+    def test_changed_mtime(self):
+        other = self.finished_batch()
+        os.utime(self.part, ns=(0, 0))
+        batch = self.new_batch()
+
+        self.assertNotEqual(batch.content_key, other.content_key)
+        self.assertFalse(reuse_zip(batch))
+        self.assertFalse(os.path.exists(os.path.join(self.root, batch.key)))
+
+    def test_closed(self):
+        self.finished_batch(state=DownloadBatch.CLOSED)
+        batch = self.new_batch()
+
+        self.assertFalse(reuse_zip(batch))
+        self.assertFalse(os.path.exists(os.path.join(self.root, batch.key)))
+
+    def test_missing(self):
+        other = self.finished_batch()
+        os.remove(self.zip_path(other, other.zip_file))
+        batch = self.new_batch()
+
+        self.assertFalse(reuse_zip(batch))
+        self.assertEqual(os.listdir(os.path.join(self.root, batch.key)), [])
+
+
+class PartDownloadFormSetTest(TestCase):
+    PARTS = ('a.prt.1', 'b.prt.1', 'c.prt.1')
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+
+        for name in self.PARTS:
+            open(os.path.join(self.path, name), 'w').close()
+
+        override = self.settings(ZWP_DATA_SOURCES=[{'name': 'test', 'path': self.path}])
+        override.enable()
+        self.addCleanup(override.disable)
+
+        self.dir = Directory._from_path('test', '', load=True)
+        self.batch = DownloadBatch.objects.create()
+
+    def formset(self, marked):
+        data = {
+            'form-TOTAL_FORMS': len(self.PARTS),
+            'form-INITIAL_FORMS': len(self.PARTS),
+        }
+
+        for i, part in enumerate(self.dir.parts):
+            if part.name in marked:
+                data['form-{}-download'.format(i)] = 'on'
+
+        request = RequestFactory().post('/', data)
+        request.user = AnonymousUser()
+        request.user.part_acl = PartAcl()
+        request.user.part_acl.add(self.dir.ds, ['@all'])
+
+        formset = PartDownloadFormSet(request, self.dir, self.batch)
+        self.assertTrue(formset.is_valid())
+        return formset
+
+    def save(self, formset, queries):
+        # Query counts include the savepoint and its release
+        with self.assertNumQueries(queries):
+            formset.save()
+
+        return formset.marked, formset.unmarked
+
+    def marked(self):
+        return sorted(self.batch.partdownload_set.values_list('part_model__name', flat=True))
+
+    def test_save(self):
+        # Part models are created on first mark
+        self.assertEqual(self.save(self.formset({'a.prt.1', 'b.prt.1'}), 7), (2, 0))
+        self.assertEqual(self.marked(), ['a.prt.1', 'b.prt.1'])
+
+        self.assertEqual(self.save(self.formset({'b.prt.1', 'c.prt.1'}), 8), (1, 1))
+        self.assertEqual(self.marked(), ['b.prt.1', 'c.prt.1'])
+
+        # Marked in the meantime, e.g. from another window
+        stale = self.formset({'a.prt.1', 'b.prt.1', 'c.prt.1'})
+        self.assertEqual(self.save(self.formset({'a.prt.1', 'b.prt.1', 'c.prt.1'}), 5), (1, 0))
+        self.assertEqual(self.save(stale, 4), (0, 0))
+        self.assertEqual(self.marked(), ['a.prt.1', 'b.prt.1', 'c.prt.1'])
@@ -1,5 +1,8 @@
 import importlib
-from .settings import ZWP_THUMBNAIL_BACKEND, ZWP_PART_THUMBNAIL_SIZE
+import os
+from .settings import ZWP_THUMBNAIL_BACKEND, ZWP_PART_THUMBNAIL_SIZE, ZWP_THUMBNAIL_INDEX_SIZE
+from .filecache import FileCache
+from .models import DataSource
 from .utils import static_url
 from .storage import DataSourceStorage
 
@@ -7,7 +10,44 @@ try:
     from easy_thumbnails.files import get_thumbnailer
 
 except ImportError:
-    pass
+    get_thumbnailer = None
+
+
+class ThumbnailIndex(FileCache):
+    """
+    Process-wide LRU cache of thumbnail directory listings, see
+    :class:`zwp.filecache.FileCache`. Thumbnail directories included by many
+    directories are listed only once per process.
+
+    Returned indexes are shared and must not be modified.
+    """
+    EXTENSIONS = ('jpg', 'png')
+
+    def get(self, path, root):
+        """
+        Return a dictionary mapping base names of images in directory ``path``
+        to their paths relative to ``root``, or ``None`` if the directory does
+        not exist.
+        """
+        return self.lookup(path, (path, root), lambda: self._index(path, root))
+
+    def _index(self, path, root):
+        files = os.listdir(path)
+        rel_path = os.path.relpath(path, root)
+        index = {}
+
+        for f in files:
+            parts = f.split('.')
+
+            if parts[-1].lower() not in self.EXTENSIONS:
+                continue
+
+            index['.'.join(parts[0:-1])] = os.path.join(rel_path, f)
+
+        return index
+
+
+thumbnail_index = ThumbnailIndex(ZWP_THUMBNAIL_INDEX_SIZE)
 
 
 def get_thumbnail_backend():
@@ -32,3 +72,19 @@ def easy_thumbnails(part):
     return {
         'thumb': thumbnailer.get_thumbnail({'size': ZWP_PART_THUMBNAIL_SIZE}),
     }
+
+
+def generate_easy_thumbnail(ds_name, path):
+    """
+    Generate thumbnail of image ``path`` from data source ``ds_name`` for
+    the easy_thumbnails backend, unless it exists and is up to date.
+    Returns ``True`` if the thumbnail was generated.
+    """
+    thumbnailer = get_thumbnailer(DataSourceStorage(DataSource.from_name(ds_name)), path)
+    options = {'size': ZWP_PART_THUMBNAIL_SIZE}
+
+    if thumbnailer.get_existing_thumbnail(options):
+        return False
+
+    thumbnailer.get_thumbnail(options)
+    return True
@@ -8,6 +8,11 @@ urlpatterns = [
         views.download,
         name='zwp_download'
     ),
+    re_path(
+        r'^download/(?P<key>[a-zA-Z0-9]+)/zip$',
+        views.download_zip,
+        name='zwp_download_zip'
+    ),
     re_path(
         r'^(?P<ds>[a-zA-Z0-9\-_]+)/(?P<path>.*)$',
         views.DirectoryContentView.as_view(),
@@ -1,19 +1,96 @@
 from django.conf import settings
+from django.core.cache import cache
 from django.utils import translation
 from django.contrib.staticfiles.storage import staticfiles_storage
+import json
 import os
 import sys
 from .models import DataSource, Directory, DownloadBatch
-from .settings import ZWP_METADATA_DIR
+from .cache import tree_node_key
+from .settings import ZWP_METADATA_DIR, ZWP_DIR_CACHE_TIMEOUT
 
 
-def format_children(d):
-    ret = []
+TREE_NODE_VERSION = 1
 
-    for child in d.children:
-        ret.append(format_dir(child))
 
-    return ret
+def tree_children(ds, path):
+    """
+    Return a tuple of ``(name, acl_users, node)`` for all children
+    of directory ``path``, where ``node`` is the child formatted by
+    :func:`format_dir` and serialized to JSON.
+
+    The tuple is cached for each language and snapshot of the directory,
+    see :attr:`Directory.content_stamp`.
+    """
+    state = Directory.cached_state(ds.name, path)
+
+    if state is not None:
+        v = cache.get(tree_node_key(ds.name, path, short_lang(), state[0]))
+
+        if v is not None and v[0] == TREE_NODE_VERSION:
+            return v[1]
+
+    d = Directory.from_path(ds.name, path, load=True)
+
+    if not d:
+        return ()
+
+    children = tuple(
+        (
+            child.name,
+            None if child.acl_users is None else tuple(sorted(child.acl_users)),
+            json.dumps(format_dir(child))
+        ) for child in d.all_children()
+    )
+
+    cache.set(
+        tree_node_key(ds.name, path, short_lang(), d.content_stamp),
+        (TREE_NODE_VERSION, children),
+        ZWP_DIR_CACHE_TIMEOUT
+    )
+    return children
+
+
+def tree_json(ds, path, user, target=None):
+    """
+    Return JSON list of tree nodes of children of directory ``path``
+    accessible by ``user``. Nodes on path ``target``, a list of names
+    of directories, are selected or opened like by :func:`format_dir`.
+    """
+    nodes = []
+
+    for name, acl_users, node in tree_children(ds, path):
+        if not Directory.acl_allows(acl_users, user):
+            continue
+
+        if target and name == target[0]:
+            node = json.loads(node)
+
+            if len(target) == 1:
+                node['state']['selected'] = True
+
+            else:
+                node['state']['opened'] = True
+                node['children'] = json.loads(tree_json(
+                    ds,
+                    os.path.join(path, name),
+                    user,
+                    target[1:]
+                ))
+
+            node = json.dumps(node)
+
+        nodes.append(node)
+
+    return '[' + ', '.join(nodes) + ']'
+
+
+def format_children(d):
+    """
+    Return JSON list of tree nodes of children of ``d`` accessible by
+    its user.
+    """
+    return tree_json(d.ds, d.full_path, d.user)
 
 
 def format_dir(d, path = []):
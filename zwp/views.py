@@ -1,21 +1,41 @@
 from django.views.generic.base import View
 from django.shortcuts import render, get_object_or_404
-from django.http import HttpResponseForbidden, HttpResponseNotAllowed, JsonResponse, \
-                        HttpResponseRedirect, HttpResponseServerError, HttpResponseBadRequest
+from django.http import HttpResponse, HttpResponseForbidden, HttpResponseNotAllowed, JsonResponse, \
+                        HttpResponseRedirect, HttpResponseServerError, HttpResponseBadRequest, \
+                        StreamingHttpResponse, Http404
 from django.forms import modelformset_factory
 from django.urls import reverse
 from django.core.exceptions import PermissionDenied
 from django.utils.translation import ugettext_lazy as _
+from django.utils import translation
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag
 from django.contrib import messages
-from .models import Directory, DownloadBatch, PartDownload
+from django.db.models import Count, Max
+import hashlib
+import os
+from .models import DataSource, Directory, DownloadBatch, PartModel, PartDownload
 from .forms import PartDownloadFormSet
 from .utils import format_children, get_or_create_download_batch, get_or_none
-from .settings import ZWP_DIR_SHOW_LABEL
-from .cache import clear_dir_content_cache
+from .settings import ZWP_DIR_SHOW_LABEL, ZWP_DIR_CONTENT_CACHE_TIMEOUT, ZWP_DOWNLOAD_STREAM, \
+                      ZWP_DOWNLOAD_WAIT_TIMEOUT, ZWP_DOWNLOAD_WAIT_INTERVAL
+from .cache import get_zip_progress, wait_zip_progress
+from .zipstream import stream_zip
 
 
 class DirectoryContentView(View):
     def dispatch(self, request, ds, path):
+        self.etag = None
+        self.states = None
+        self.batch = None
+
+        if request.method in ('GET', 'HEAD'):
+            self.batch = get_or_none(request.session, 'zwp_download_batch', DownloadBatch)
+            response = self._precondition(request, ds, path)
+
+            if response is not None:
+                return response
+
         d = Directory.from_path(ds, path, user=request.user, load=True)
 
         if d is False or not d.accessible:
@@ -24,20 +44,31 @@ class DirectoryContentView(View):
         return super(DirectoryContentView, self).dispatch(request, d)
 
     def get(self, request, d):
-        batch = get_or_none(request.session, 'zwp_download_batch', DownloadBatch)
-        formset = self._formset(request, batch, d)
+        formset = self._formset(request, self.batch, d)
+        response = self._render(request, d, formset)
+
+        # The ETag is sent only if the rendered snapshots are those the ETag
+        # was derived from, see _precondition()
+        if self.etag is not None and response.status_code == 200 \
+           and self._states(d.ds.name, d.full_path) == self.states:
+            self._set_validator(response)
 
+        return response
+
+    def _render(self, request, d, formset):
         if request.is_ajax():
             fetch = request.GET.get('fetch', None)
 
             if fetch == 'tree':
-                return JsonResponse(format_children(d), safe=False)
+                return HttpResponse(format_children(d), content_type='application/json')
 
             if fetch == 'content':
                 return render(request, 'zwp/dir_content.html', {
                     'zwp_dir': d,
                     'formset': formset,
                     'show_label': ZWP_DIR_SHOW_LABEL,
+                    'content_cache_timeout': ZWP_DIR_CONTENT_CACHE_TIMEOUT,
+                    'acl_fingerprint': request.user.part_acl.fingerprint(d.ds),
                 })
 
             return HttpResponseForbidden()
@@ -46,12 +77,13 @@ class DirectoryContentView(View):
             'zwp_dir': d,
             'formset': formset,
             'show_label': ZWP_DIR_SHOW_LABEL,
+            'content_cache_timeout': ZWP_DIR_CONTENT_CACHE_TIMEOUT,
+            'acl_fingerprint': request.user.part_acl.fingerprint(d.ds),
         })
 
     def post(self, request, d):
         batch = get_or_create_download_batch(request)
         formset = self._formset(request, batch, d)
-        clear_dir_content_cache(request, d)
 
         if formset.is_valid():
             formset.save()
@@ -83,8 +115,80 @@ class DirectoryContentView(View):
             'zwp_dir': d,
             'formset': formset,
             'show_label': ZWP_DIR_SHOW_LABEL,
+            'content_cache_timeout': ZWP_DIR_CONTENT_CACHE_TIMEOUT,
+            'acl_fingerprint': request.user.part_acl.fingerprint(d.ds),
         })
 
+    def _precondition(self, request, ds_name, path):
+        """
+        Evaluate conditional requests before the directory is loaded. Sets
+        :attr:`etag` and returns a response if the request is answered from
+        the cached state of the directory, or ``None``.
+
+        The ETag is derived from content stamps of the directory and its
+        ancestors, whose children are shown in the directory tree, see
+        :meth:`Directory.cached_state`. Without cached stamps, the page
+        is rendered without an ETag.
+        """
+        ds = DataSource.from_name(ds_name)
+
+        if ds is None or (path and os.path.normpath(path) != path):
+            return None
+
+        states = self._states(ds.name, path)
+
+        if None in states:
+            return None
+
+        if not Directory.acl_allows(states[-1][1], request.user):
+            return HttpResponseForbidden()
+
+        # Pending messages are shown only by a rendered page, which must not
+        # be reused
+        if len(messages.get_messages(request)):
+            return None
+
+        if self.batch:
+            downloads = self.batch.partdownload_set.aggregate(n=Count('pk'), last=Max('pk'))
+            batch_state = '{}:{n}:{last}'.format(self.batch.pk, **downloads)
+
+        else:
+            batch_state = ''
+
+        h = hashlib.sha256('\n'.join([
+            ','.join(str(stamp) for stamp, acl in states),
+            request.GET.get('fetch', ''),
+            request.user.username,
+            request.user.part_acl.fingerprint(ds),
+            translation.get_language() or '',
+            batch_state,
+        ]).encode('utf-8', 'surrogateescape'))
+
+        self.etag = quote_etag(h.hexdigest())
+        self.states = states
+        response = get_conditional_response(request, etag=self.etag)
+
+        if response is not None:
+            self._set_validator(response)
+
+        return response
+
+    def _states(self, ds_name, path):
+        """
+        Return cached states of directory ``path`` and its ancestors, starting
+        with the root directory, see :meth:`Directory.cached_state`.
+        """
+        components = path.split('/') if path else []
+
+        return [
+            Directory.cached_state(ds_name, '/'.join(components[0:i]))
+            for i in range(len(components) + 1)
+        ]
+
+    def _set_validator(self, response):
+        response['ETag'] = self.etag
+        patch_cache_control(response, private=True, no_cache=True)
+
     def _formset(self, request, batch, d):
         return PartDownloadFormSet(
             request,
@@ -123,9 +227,6 @@ class DownloadsView(View):
         )
 
         if formset.is_valid():
-            for dl in self._queryset(batch):
-                clear_dir_content_cache(request, dl.part_model.part.dir)
-
             if 'download' in request.POST:
                 if batch.make_zip():
                     del request.session['zwp_download_batch']
@@ -154,9 +255,14 @@ class DownloadsView(View):
         })
 
     def _queryset(self, batch):
-        return batch.partdownload_set.select_related('part_model').all() \
+        qs = batch.partdownload_set.select_related('part_model').all() \
             .order_by('part_model__name')
 
+        # Evaluate the queryset and resolve all parts at once, the formset
+        # then uses the cached results
+        PartModel.resolve([dl.part_model for dl in qs])
+        return qs
+
 
 def download(request, key):
     batch = get_object_or_404(
@@ -168,13 +274,64 @@ def download(request, key):
         raise PermissionDenied()
 
     if request.is_ajax():
+        # Polled repeatedly, parts are not resolved and the ZIP file is
+        # checked only when there is no progress published by the ZIP builder,
+        # e.g. with a cache not shared between processes
+        progress = get_zip_progress(batch.pk)
+
+        if progress is not None and ZWP_DOWNLOAD_WAIT_TIMEOUT > 0 \
+           and 'since' in request.GET and 'state' in request.GET:
+            # Long poll, respond when the client's progress is outdated
+            try:
+                progress = wait_zip_progress(
+                    batch.pk,
+                    int(request.GET['since']),
+                    int(request.GET['state']),
+                    ZWP_DOWNLOAD_WAIT_TIMEOUT,
+                    ZWP_DOWNLOAD_WAIT_INTERVAL
+                )
+
+            except ValueError:
+                return HttpResponseBadRequest()
+
+            if progress is not None and progress['state'] != batch.state:
+                batch.refresh_from_db()
+
+        if progress is None:
+            progress = {'zip_size': batch.zip_size, 'bytes_total': batch.stored_size()}
+
         return JsonResponse({
             'state': batch.state,
-            'approx_size': batch.size,
-            'real_size': batch.zip_size,
+            'seq': progress.get('seq') if ZWP_DOWNLOAD_WAIT_TIMEOUT > 0 else None,
+            'approx_size': progress.get('bytes_total'),
+            'real_size': progress.get('zip_size'),
+            'files_done': progress.get('files_done'),
+            'files_total': progress.get('files_total'),
+            'bytes_done': progress.get('bytes_done'),
             'url': batch.zip_url,
         })
 
     return render(request, 'zwp/download.html', {
         'batch': batch,
     })
+
+
+def download_zip(request, key):
+    if not ZWP_DOWNLOAD_STREAM:
+        raise Http404()
+
+    batch = get_object_or_404(
+        DownloadBatch,
+        key=key,
+        state=DownloadBatch.DONE
+    )
+
+    if batch.user and batch.user != request.user:
+        raise PermissionDenied()
+
+    response = StreamingHttpResponse(
+        stream_zip((path, arcname) for path, arcname, ds in batch.zip_files()),
+        content_type='application/zip'
+    )
+    response['Content-Disposition'] = 'attachment; filename="{}.zip"'.format(batch.zip_file)
+    return response
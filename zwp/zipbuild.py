@@ -0,0 +1,299 @@
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import timezone
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import bz2
+import os
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
+import zlib
+from zipfile import ZipFile, ZipInfo, ZIP_STORED, ZIP_DEFLATED, ZIP_BZIP2, ZIP_LZMA
+from .cache import set_zip_progress
+from .models import DownloadBatch
+from .settings import ZWP_DOWNLOAD_ROOT, ZWP_DOWNLOAD_COMPRESS_THREADS
+
+
+COMPRESSION = {
+    'stored': ZIP_STORED,
+    'deflated': ZIP_DEFLATED,
+    'bzip2': ZIP_BZIP2,
+    'lzma': ZIP_LZMA,
+}
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class ZipProgress:
+    """
+    Progress of ZIP file creation, published in the cache for the download
+    status view, see :func:`zwp.cache.get_zip_progress`. Updates are published
+    at most every ``interval`` seconds, each with a new sequence number.
+    """
+    def __init__(self, batch, files, interval=0.5):
+        self.batch_pk = batch.pk
+        self.interval = interval
+        self.state = batch.state
+        self.seq = 0
+        self.files_done = 0
+        self.files_total = len(files)
+        self.bytes_done = 0
+        self.bytes_total = sum(os.path.getsize(f[0]) for f in files)
+        self.zip_size = 0
+        self._published = 0
+        self._lock = threading.Lock()
+        self.publish()
+
+    def add(self, size, zip_size):
+        with self._lock:
+            self.files_done += 1
+            self.bytes_done += size
+            self.zip_size = zip_size
+
+            if self.files_done == self.files_total \
+               or time.monotonic() - self._published >= self.interval:
+                self.publish()
+
+    def publish(self):
+        self._published = time.monotonic()
+        self.seq += 1
+        set_zip_progress(self.batch_pk, {
+            'seq': self.seq,
+            'state': self.state,
+            'files_done': self.files_done,
+            'files_total': self.files_total,
+            'bytes_done': self.bytes_done,
+            'bytes_total': self.bytes_total,
+            'zip_size': self.zip_size,
+        })
+
+
+def zip_paths(batch):
+    """
+    Return a tuple of ZIP file name without extension, its directory and
+    full path for download batch ``batch``.
+    """
+    name = 'parts-{}'.format(batch.pk)
+    d = os.path.join(ZWP_DOWNLOAD_ROOT, batch.key)
+    return name, d, os.path.join(d, name + '.zip')
+
+
+def build_zip(batch):
+    """
+    Create the ZIP file of ``batch``, which is being prepared. The batch
+    state is set to ``DONE``, or to ``ERROR`` if the file could not be created,
+    in which case the exception is raised again.
+    """
+    progress = None
+
+    try:
+        zip_name, zip_dir, zip_path = zip_paths(batch)
+
+        os.makedirs(zip_dir, exist_ok=True)
+
+        files = batch.zip_files()
+        progress = ZipProgress(batch, files)
+        write_zip(zip_path, files, progress=progress)
+
+        batch.state = batch.DONE
+        batch.updated_at = timezone.now()
+        progress.zip_size = os.path.getsize(zip_path)
+
+    except Exception as e:
+        batch.state = batch.ERROR
+        raise e
+
+    finally:
+        batch.save()
+
+        # Published after the batch is saved, so that waiting clients
+        # see the new state
+        if progress is not None:
+            progress.state = batch.state
+            progress.publish()
+
+
+def write_zip(zip_path, files, threads=ZWP_DOWNLOAD_COMPRESS_THREADS, progress=None):
+    """
+    Write ``files``, a list of ``(path, arcname, ds)`` tuples, into a new ZIP
+    file at ``zip_path``, compressed as configured for their data sources.
+
+    Compressed entries are created in parallel by up to ``threads`` threads
+    into temporary files, which are then copied into the archive in order.
+    Only a few entries are compressed ahead, so that the number of temporary
+    files stays bounded. Written entries are reported to ``progress``,
+    a :class:`ZipProgress`, if given.
+    """
+    with ZipFile(zip_path, 'w') as zip, ThreadPoolExecutor(max_workers=threads) as pool:
+        pending = deque()  # (future, path, arcname), future is None for stored files
+
+        def write_next():
+            future, path, arcname = pending.popleft()
+
+            if future is None:
+                zip.write(path, arcname)
+                info = zip.filelist[-1]
+
+            else:
+                info, tmp = future.result()
+
+                with tmp:
+                    _write_compressed(zip, info, tmp)
+
+            if progress is not None:
+                progress.add(info.file_size, zip.fp.tell())
+
+        for path, arcname, ds in files:
+            compress_type, level = compression(ds)
+
+            if compress_type == ZIP_STORED:
+                future = None
+
+            else:
+                future = pool.submit(
+                    _compress_file,
+                    path,
+                    arcname,
+                    compress_type,
+                    level,
+                    os.path.dirname(zip_path)
+                )
+
+            pending.append((future, path, arcname))
+
+            if len(pending) > threads * 2:
+                write_next()
+
+        while pending:
+            write_next()
+
+
+def compression(ds):
+    """
+    Return a tuple of ZIP compression type and level for data source ``ds``.
+    """
+    try:
+        return COMPRESSION[ds.compression], ds.compresslevel
+
+    except KeyError:
+        raise ImproperlyConfigured('Unknown ZIP compression "{}", use one of: {}'.format(
+            ds.compression,
+            ', '.join(COMPRESSION.keys())
+        ))
+
+
+def _compressor(compress_type, level):
+    if compress_type == ZIP_DEFLATED:
+        return zlib.compressobj(
+            zlib.Z_DEFAULT_COMPRESSION if level is None else level,
+            zlib.DEFLATED,
+            -15
+        )
+
+    elif compress_type == ZIP_BZIP2:
+        return bz2.BZ2Compressor(9 if level is None else level)
+
+    # Compression level is not supported by zipfile for LZMA
+    return zipfile.LZMACompressor()
+
+
+def _compress_file(path, arcname, compress_type, level, tmp_dir):
+    """
+    Compress file ``path`` into a temporary file. Returns a tuple of
+    :class:`ZipInfo` describing the entry and the temporary file with
+    compressed data.
+    """
+    info = ZipInfo.from_file(path, arcname)
+    info.compress_type = compress_type
+
+    if compress_type == ZIP_LZMA:
+        # End-of-stream marker is present
+        info.flag_bits |= 0x02
+
+    compressor = _compressor(compress_type, level)
+    crc = 0
+    size = 0
+    tmp = tempfile.TemporaryFile(dir=tmp_dir)
+
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+
+                if not chunk:
+                    break
+
+                crc = zlib.crc32(chunk, crc)
+                size += len(chunk)
+                tmp.write(compressor.compress(chunk))
+
+        tmp.write(compressor.flush())
+
+    except Exception:
+        tmp.close()
+        raise
+
+    info.file_size = size
+    info.CRC = crc
+    info.compress_size = tmp.tell()
+    tmp.seek(0)
+
+    return info, tmp
+
+
+def _write_compressed(zip, info, data):
+    """
+    Append an entry with already compressed ``data`` to ``zip``, the same
+    way as :meth:`ZipFile.writestr` does with data it compresses itself.
+    """
+    info.header_offset = zip.fp.tell()
+    zip.fp.write(info.FileHeader())
+    shutil.copyfileobj(data, zip.fp, CHUNK_SIZE)
+    zip.filelist.append(info)
+    zip.NameToInfo[info.filename] = info
+    zip.start_dir = zip.fp.tell()
+
+
+def reuse_zip(batch):
+    """
+    Satisfy ``batch`` with the ZIP file of a finished batch with the same
+    content key, which is hard linked into the directory of ``batch``.
+    Returns ``True`` if an existing ZIP file was reused.
+
+    Only batches in the ``DONE`` state are considered, so files expired
+    by the cleanupdownloads command are never reused. The reused file keeps
+    its name, as it is also the name of the directory inside the archive.
+    """
+    if not batch.content_key:
+        return False
+
+    others = DownloadBatch.objects.filter(
+        content_key=batch.content_key,
+        state=DownloadBatch.DONE
+    ).exclude(pk=batch.pk).order_by('-updated_at')
+
+    for other in others:
+        src = os.path.join(ZWP_DOWNLOAD_ROOT, other.key, other.zip_file + '.zip')
+        zip_dir = os.path.join(ZWP_DOWNLOAD_ROOT, batch.key)
+
+        os.makedirs(zip_dir, exist_ok=True)
+
+        try:
+            os.link(src, os.path.join(zip_dir, other.zip_file + '.zip'))
+
+        except FileNotFoundError:
+            # Removed in the meantime
+            continue
+
+        except OSError:
+            return False
+
+        batch.zip_file = other.zip_file
+        batch.state = batch.DONE
+        batch.updated_at = timezone.now()
+        batch.save()
+        return True
+
+    return False
@@ -0,0 +1,64 @@
+from zipfile import ZipFile, ZipInfo, ZIP_STORED
+
+
+CHUNK_SIZE = 64 * 1024
+
+
+class _ChunkBuffer:
+    """
+    Write-only file object collecting data written by :class:`ZipFile`
+    until it is taken by :func:`stream_zip`. It is not seekable, so that
+    the ZIP file is written sequentially with data descriptors.
+    """
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_zip(files, compression=ZIP_STORED):
+    """
+    Generate a ZIP archive of ``files`` in chunks, without creating
+    a temporary file. ``files`` is an iterable of ``(path, arcname)`` tuples.
+    At most one chunk of a part file is held in memory at a time.
+    """
+    buf = _ChunkBuffer()
+
+    with ZipFile(buf, 'w', compression) as zip:
+        for path, arcname in files:
+            info = ZipInfo.from_file(path, arcname)
+            info.compress_type = compression
+
+            with open(path, 'rb') as src, zip.open(info, 'w') as dst:
+                while True:
+                    chunk = src.read(CHUNK_SIZE)
+
+                    if not chunk:
+                        break
+
+                    dst.write(chunk)
+                    data = buf.take()
+
+                    if data:
+                        yield data
+
+            data = buf.take()
+
+            if data:
+                yield data
+
+    # The central directory is written on close
+    data = buf.take()
+
+    if data:
+        yield data